@@ -0,0 +1,86 @@
+from json import dump
+from os import environ
+
+from BatchRunner import BatchRunner
+from constants import (
+    CPU_BUDGET_ENV,
+    DEFAULT_ENCODE_PROFILE,
+    SCRATCH_TIERS,
+    SYNC_MEMORY_BYTES,
+)
+
+OPTIONS = dict(
+    start=0,
+    duration=5,
+    encode_profile=DEFAULT_ENCODE_PROFILE,
+    time_budget=None,
+    backend="opencv",
+    render_workers=1,
+    seed=None,
+    dry_run=False,
+    preview=False,
+    cache_dir=None,
+    cache_size=0,
+    normalize=False,
+    scratch_tiers=SCRATCH_TIERS,
+    sync_memory_bytes=SYNC_MEMORY_BYTES,
+    sync_engine="waveform",
+    sync_refine=False,
+    sync_stream=False,
+    debug=False,
+)
+
+
+def manifest(tmp_path, jobs):
+    path = str(tmp_path / "manifest.json")
+    with open(path, "w") as f:
+        dump(jobs, f)
+    return path
+
+
+def test_resume_renders_unfinished_jobs_only(tmp_path):
+    jobs = [
+        {"folder": "a", "start": 0, "duration": 5, "output": "out/a.mp4"},
+        {"folder": "b", "start": 0, "duration": 5, "output": "out/b.mp4"},
+        {"folder": "c", "start": 0, "duration": 5, "output": "out/c.mp4"},
+        {"folder": "d", "start": 0, "duration": 5, "output": "out/d.mp4"},
+    ]
+    batch_runner = BatchRunner(manifest(tmp_path, jobs), OPTIONS)
+    done, failed, deleted, new = batch_runner.jobs
+    (tmp_path / "out").mkdir()
+    for job in (done, failed):
+        open(job["output"], "w").close()
+    batch_runner.state.set(batch_runner.job_key(done), {"status": "done", "elapsed": 1.0})
+    batch_runner.state.set(batch_runner.job_key(failed), {"status": "failed", "error": ""})
+    # done, but its output was deleted since
+    batch_runner.state.set(batch_runner.job_key(deleted), {"status": "done", "elapsed": 1.0})
+    batch_runner.state.save()
+    batch_runner = BatchRunner(manifest(tmp_path, jobs), OPTIONS)
+    assert [job["folder"] for job in batch_runner.pending_jobs()] == [
+        failed["folder"],
+        deleted["folder"],
+        new["folder"],
+    ]
+
+
+def test_failed_jobs_are_kept_in_the_state(tmp_path):
+    jobs = [{"folder": "missing", "start": 0, "duration": 5, "output": "out/a.mp4"}]
+    batch_runner = BatchRunner(manifest(tmp_path, jobs), OPTIONS, workers=1)
+    previous_budget = environ.get(CPU_BUDGET_ENV)
+    assert not batch_runner.run()
+    # the share of the budget is only set for the workers
+    assert environ.get(CPU_BUDGET_ENV) == previous_budget
+    state = BatchRunner(manifest(tmp_path, jobs), OPTIONS).state
+    assert state.get(batch_runner.job_key(batch_runner.jobs[0]))["status"] == "failed"
+    assert len(BatchRunner(manifest(tmp_path, jobs), OPTIONS).pending_jobs()) == 1
+
+
+def test_nothing_to_render(tmp_path):
+    jobs = [{"folder": "a", "start": 0, "duration": 5, "output": "a.mp4"}]
+    batch_runner = BatchRunner(manifest(tmp_path, jobs), OPTIONS)
+    open(batch_runner.jobs[0]["output"], "w").close()
+    batch_runner.state.set(
+        batch_runner.job_key(batch_runner.jobs[0]), {"status": "done", "elapsed": 1.0}
+    )
+    batch_runner.state.save()
+    assert BatchRunner(manifest(tmp_path, jobs), OPTIONS).run()
@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from EditDecisionList import EditDecisionList
+from VideoEditor import VideoEditor
+
+
+def planner(start=10, duration=20):
+    # a video editor with three synced videos, without processing any file
+    video_editor = VideoEditor.__new__(VideoEditor)
+    video_editor.video_out_fps = 30
+    video_editor.start = start
+    video_editor.video_duration = duration
+    video_editor.start_offsets = [0.0, -5.0, 2.0]
+    video_editor.finish_offsets = [0.0, 10.0, 0.0]
+    video_editor.file_manager = SimpleNamespace(
+        audio_duration=60.0, video_filepaths=["/a/v1.mp4", "/a/v2.mp4", "/a/v3.mov"]
+    )
+    video_editor.multitake = SimpleNamespace(
+        audio_beats=list(range(0, 30 * 60, 15)),
+        get_source_frames=lambda video_idx, times: np.round(times * 30).astype(np.int64),
+    )
+    return video_editor
+
+
+def test_same_seed_same_plan():
+    plan = planner().plan_segments(7)
+    assert plan.seed == 7
+    assert np.array_equal(plan.segments, planner().plan_segments(7).segments)
+    assert not np.array_equal(plan.video_idxs, planner().plan_segments(8).video_idxs)
+    # segments follow each other and cover the whole duration
+    assert plan.out_frames[0] == 0
+    assert np.array_equal(plan.out_frames[1:], (plan.out_frames + plan.segments[:, 3])[:-1])
+    assert plan.out_frames[-1] + plan.segments[-1, 3] == 20 * 30
+
+
+def test_save_load(tmp_path):
+    plan = planner().plan_segments(7)
+    plan.save(str(tmp_path / "out.plan.json"))
+    loaded = EditDecisionList.load(str(tmp_path / "out.plan.json"))
+    assert np.array_equal(loaded.segments, plan.segments)
+    assert (loaded.start, loaded.duration, loaded.video_names, loaded.seed) == (
+        10,
+        20,
+        ["v1.mp4", "v2.mp4", "v3.mov"],
+        7,
+    )
+    assert list(loaded) == list(plan)
+    assert np.array_equal(
+        planner().load_plan(str(tmp_path / "out.plan.json")).segments, plan.segments
+    )
+
+
+def test_load_plan_of_another_cut(tmp_path):
+    planner().plan_segments(7).save(str(tmp_path / "out.plan.json"))
+    with pytest.raises(ValueError):
+        planner(start=11).load_plan(str(tmp_path / "out.plan.json"))
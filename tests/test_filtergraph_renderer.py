@@ -0,0 +1,22 @@
+import numpy as np
+from FilterGraphRenderer import FilterGraphRenderer
+
+
+def test_one_input_per_video():
+    frame_pts = [np.arange(300) / 30, np.arange(250) / 25]
+    renderer = FilterGraphRenderer(
+        ["a.mp4", "b.mp4"], frame_pts, [(100, 200), (100, 200)], 90, 160, 30, [], 2
+    )
+    segments = [(0, 30, 0, 15), (1, 30, 15, 15), (0, 60, 30, 15), (1, 50, 45, 15)]
+    argv = renderer.command(segments, "audio.wav", "out.mp4")
+    assert [argv[i + 1] for i, arg in enumerate(argv) if arg == "-i"] == [
+        "a.mp4",
+        "b.mp4",
+        "audio.wav",
+    ]
+    filters = argv[argv.index("-filter_complex") + 1].split(";")
+    assert filters[0].startswith("[0:v]split=2")
+    assert filters[1].startswith("[1:v]split=2")
+    # trims start halfway from the previous frame, relative to the seek of the input
+    assert "trim=start=1.000000," in filters[4]
+    assert argv[argv.index("-map", argv.index("[outv]")) + 1] == "2:a"
@@ -0,0 +1,30 @@
+import numpy as np
+from constants import SYNC_FINGERPRINT_MIN_CONFIDENCE
+from FingerprintSynchronizer import FingerprintSynchronizer
+from test_synchronizer import SAMPLE_RATE, music
+
+
+def rhythmic_music(seed, seconds):
+    # the same two second bar over and over, with a melody on top
+    rng = np.random.default_rng(seed)
+    bar = np.tile(music(rng, 2), seconds // 2)
+    return bar + 0.3 * music(rng, seconds)
+
+
+def test_rhythmic_take_is_confident():
+    reference = rhythmic_music(0, 120)
+    synchronizer = FingerprintSynchronizer(FingerprintSynchronizer.fingerprint(reference))
+    start = 37 * SAMPLE_RATE
+    take = reference[start : start + 20 * SAMPLE_RATE]
+    take = take + 0.1 * np.random.default_rng(1).standard_normal(len(take))
+    offset, confidence = synchronizer.find_offset(FingerprintSynchronizer.fingerprint(take))
+    assert abs(offset + start) <= synchronizer.hop_length
+    assert confidence >= SYNC_FINGERPRINT_MIN_CONFIDENCE
+
+
+def test_unrelated_take_is_ambiguous():
+    reference = rhythmic_music(0, 120)
+    synchronizer = FingerprintSynchronizer(FingerprintSynchronizer.fingerprint(reference))
+    take = music(np.random.default_rng(2), 20)
+    _, confidence = synchronizer.find_offset(FingerprintSynchronizer.fingerprint(take))
+    assert confidence < SYNC_FINGERPRINT_MIN_CONFIDENCE
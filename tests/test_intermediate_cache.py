@@ -0,0 +1,109 @@
+from os import link, listdir, utime
+from subprocess import run
+
+import numpy as np
+from FfmpegWraper import FFmpegWrapper
+from IntermediateCache import IntermediateCache
+
+
+def write(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_put_get_file(tmp_path):
+    cache = IntermediateCache(str(tmp_path / "cache"))
+    write(tmp_path / "a.wav", "audio")
+    cache.put_file("k", str(tmp_path / "a.wav"))
+    assert cache.get_file("k", str(tmp_path / "b.wav"))
+    assert read(tmp_path / "b.wav") == "audio"
+    assert not cache.get_file("missing", str(tmp_path / "c.wav"))
+
+
+def test_entries_survive_rewriting_their_files(tmp_path):
+    cache = IntermediateCache(str(tmp_path / "cache"))
+    write(tmp_path / "a.wav", "old")
+    cache.put_file("k", str(tmp_path / "a.wav"))
+    write(tmp_path / "a.wav", "new")
+    assert cache.get_file("k", str(tmp_path / "b.wav"))
+    write(tmp_path / "b.wav", "newer")
+    assert cache.get_file("k", str(tmp_path / "c.wav"))
+    assert read(tmp_path / "c.wav") == "old"
+
+
+def test_get_file_onto_the_same_inode(tmp_path):
+    cache = IntermediateCache(str(tmp_path / "cache"))
+    write(tmp_path / "a.wav", "audio")
+    cache.put_file("k", str(tmp_path / "a.wav"))
+    link(cache._entry_path("k"), tmp_path / "b.wav")
+    assert cache.get_file("k", str(tmp_path / "b.wav"))
+    assert read(tmp_path / "b.wav") == "audio"
+    assert read(cache._entry_path("k")) == "audio"
+
+
+def test_arrays_and_json(tmp_path):
+    cache = IntermediateCache(str(tmp_path / "cache"))
+    cache.put_array("a", np.arange(5))
+    cache.put_json("j", {"x": [1, 2]})
+    assert np.array_equal(cache.get_array("a"), np.arange(5))
+    assert cache.get_json("j") == {"x": [1, 2]}
+    assert cache.get_array("missing") is None
+    assert cache.get_json("missing") is None
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = IntermediateCache(str(tmp_path / "cache"), max_bytes=25)
+    for i, key in enumerate("abc"):
+        write(tmp_path / key, "x" * 10)
+        cache.put_file(key, str(tmp_path / key))
+        utime(cache._entry_path(key), (i, i))
+    # reading an entry makes it the most recently used
+    assert cache.get_file("a", str(tmp_path / "restored"))
+    cache.evict()
+    assert sorted(listdir(cache.entries_folder)) == ["a", "c"]
+
+
+def test_final_outputs_are_not_cached(tmp_path):
+    cache = IntermediateCache(str(tmp_path / "cache"))
+    ffmpeg_commands = FFmpegWrapper(cache=cache)
+    for name in ("chunk0.ts", "audio.wav"):
+        write(tmp_path / name, name)
+    ffmpeg_commands.concat_video_and_audio(
+        [str(tmp_path / "chunk0.ts")], str(tmp_path / "audio.wav"), str(tmp_path / "out.mp4")
+    )
+    ((_, o_path, i_paths),) = ffmpeg_commands.current_command_batch
+    assert o_path == str(tmp_path / "out.mp4")
+    assert i_paths is None
+
+
+def test_cached_outputs_are_restored_instead_of_run(tmp_path):
+    cache = IntermediateCache(str(tmp_path / "cache"))
+    ffmpeg_commands = FFmpegWrapper(cache=cache)
+    i_path = str(tmp_path / "audio.wav")
+    run(
+        ["ffmpeg", "-loglevel", "error", "-f", "lavfi", "-i", "sine=d=2", i_path],
+        check=True,
+    )
+    for folder in ("first", "second"):
+        (tmp_path / folder).mkdir()
+    (result,) = ffmpeg_commands.run_command(
+        ffmpeg_commands.cut_audio, i_path, str(tmp_path / "first" / "cut.wav"), 0.5, 1.0
+    )
+    assert result.return_code == 0
+    # the same cut in another folder is copied from the cache
+    assert not ffmpeg_commands.run_command(
+        ffmpeg_commands.cut_audio, i_path, str(tmp_path / "second" / "cut.wav"), 0.5, 1.0
+    )
+    assert read_bytes(tmp_path / "second" / "cut.wav") == read_bytes(
+        tmp_path / "first" / "cut.wav"
+    )
@@ -0,0 +1,87 @@
+import sys
+from time import perf_counter
+
+import pytest
+from JobScheduler import JobScheduler, TaskGraph
+
+
+def sleep(seconds, code=0):
+    return [sys.executable, "-c", f"import time; time.sleep({seconds}); exit({code})"]
+
+
+def touch(path):
+    return [sys.executable, "-c", f"open({str(path)!r}, 'w').close()"]
+
+
+def test_results_in_submission_order():
+    scheduler = JobScheduler(cpu_budget=4, threads_per_job=1)
+    # the first jobs finish last
+    jobs = [sleep(seconds) for seconds in (0.3, 0.2, 0.1, 0.0)]
+    results = scheduler.run(jobs)
+    assert [result.argv for result in results] == jobs
+    assert all(result.return_code == 0 for result in results)
+
+
+def test_chain_stops_at_first_failure(tmp_path):
+    scheduler = JobScheduler(cpu_budget=1, threads_per_job=1)
+    (result,) = scheduler.run([[sleep(0), sleep(0, 3), touch(tmp_path / "after")]])
+    assert result.return_code == 3
+    assert result.argv == sleep(0, 3)
+    assert not (tmp_path / "after").exists()
+
+
+@pytest.mark.parametrize(
+    "cpu_budget, threads_per_job, n_jobs, max_workers",
+    [(8, 3, 10, 2), (8, 2, 3, 3), (2, 4, 5, 1), (4, 1, 0, 1)],
+)
+def test_worker_cap(cpu_budget, threads_per_job, n_jobs, max_workers):
+    scheduler = JobScheduler(cpu_budget, threads_per_job)
+    assert scheduler.max_workers(n_jobs) == max_workers
+
+
+def test_running_jobs_keep_to_the_budget():
+    scheduler = JobScheduler(cpu_budget=2, threads_per_job=1)
+    start = perf_counter()
+    scheduler.run([sleep(0.3)] * 4)
+    # two at a time
+    assert perf_counter() - start >= 0.6
+
+
+def test_task_graph_runs_tasks_after_their_dependencies():
+    order = []
+
+    def task(name, value):
+        def run(*dependency_results):
+            order.append(name)
+            return value + sum(dependency_results)
+
+        return run
+
+    graph = TaskGraph(max_workers=4)
+    graph.add("a", task("a", 1))
+    graph.add("b", task("b", 10), ["a"])
+    graph.add("c", task("c", 100), ["a"])
+    graph.add("d", task("d", 1000), ["b", "c"])
+    results = graph.run()
+    assert results == {"a": 1, "b": 11, "c": 101, "d": 1112}
+    assert order[0] == "a" and order[-1] == "d"
+
+
+def test_task_graph_raises_the_first_failure():
+    ran = []
+
+    def fail():
+        raise RuntimeError("decode failed")
+
+    graph = TaskGraph(max_workers=2)
+    graph.add("fail", fail)
+    graph.add("after", lambda _: ran.append("after"), ["fail"])
+    with pytest.raises(RuntimeError, match="decode failed"):
+        graph.run()
+    assert not ran
+
+
+def test_task_graph_unknown_dependency():
+    graph = TaskGraph()
+    with pytest.raises(ValueError):
+        graph.add("a", lambda _: None, ["missing"])
@@ -0,0 +1,37 @@
+from multiprocessing import get_context
+
+from JsonCache import JsonCache
+
+
+def write_entries(path, worker, n_entries):
+    for idx in range(n_entries):
+        cache = JsonCache(path)
+        cache.set(f"{worker}|{idx}", idx)
+        cache.save()
+
+
+def test_saves_merge_with_the_file(tmp_path):
+    path = str(tmp_path / "cache.json")
+    first, second = JsonCache(path), JsonCache(path)
+    first.set("a", 1)
+    second.set("b", 2)
+    first.save()
+    second.save()
+    assert JsonCache(path).entries == {"a": 1, "b": 2}
+    # saving also reads what the others saved
+    assert second.get("a") == 1
+
+
+def test_concurrent_saves(tmp_path):
+    path = str(tmp_path / "cache.json")
+    context = get_context("fork")
+    processes = [
+        context.Process(target=write_entries, args=(path, worker, 20)) for worker in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+    entries = JsonCache(path).entries
+    assert entries == {f"{worker}|{idx}": idx for worker in range(4) for idx in range(20)}
@@ -0,0 +1,78 @@
+from subprocess import run
+
+import cv2
+import numpy as np
+import pytest
+from FfmpegWraper import FFmpegWrapper
+from FrameIndex import FrameIndex
+
+FPS = 30
+GOP = 10
+
+
+def decode(path):
+    # small gray frames of a video
+    capture = cv2.VideoCapture(path)
+    frames = []
+    while True:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        frames.append(cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (32, 32)))
+    capture.release()
+    return np.array(frames, np.float32).reshape(len(frames), -1)
+
+
+@pytest.fixture(scope="module", params=[("mp4", 0.0), ("mkv", 1.4)])
+def source(request, tmp_path_factory):
+    # a file whose first frame is at start_time, the frame times are indexed by ffprobe
+    extension, start_time = request.param
+    folder = tmp_path_factory.mktemp("source")
+    path = str(folder / f"source.{extension}")
+    run(
+        ["ffmpeg", "-loglevel", "error", "-f", "lavfi", "-i"]
+        + [f"testsrc2=size=128x128:rate={FPS}:duration=4"]
+        + ["-c:v", "libx264", "-g", str(GOP), "-keyint_min", str(GOP), "-sc_threshold", "0"]
+        + ["-bf", "0", "-pix_fmt", "yuv420p", "-output_ts_offset", str(start_time), path],
+        check=True,
+    )
+    frame_times = FrameIndex(str(folder / "index")).get(path)
+    assert abs(frame_times.pts[0] - start_time) < 0.01
+    return path, frame_times, decode(path)
+
+
+def source_frames(frames, source_frames):
+    # index of the source frame closest to each frame
+    distances = np.abs(frames[:, None, :] - source_frames[None, :, :]).mean(axis=2)
+    return distances.argmin(axis=1).tolist()
+
+
+@pytest.mark.parametrize(
+    "start, duration, first_frame, last_frame",
+    [
+        # a bit before a frame, within the tolerance of the rounding of the offsets
+        (25 / FPS - 0.004, 2.0, 25, 85),
+        (25 / FPS + 0.004, 2.0, 25, 85),
+        (GOP / FPS, 1.0, 10, 40),
+        (0.0, 1.5, 0, 45),
+    ],
+)
+def test_smart_cut_parts(tmp_path, source, start, duration, first_frame, last_frame):
+    path, frame_times, frames = source
+    o_path = str(tmp_path / "cut.mp4")
+    ffmpeg_commands = FFmpegWrapper("archive")
+    ffmpeg_commands.cut_video(path, o_path, start, duration, frame_times, smart_cut=True)
+    ((commands, _, _),) = ffmpeg_commands.current_command_batch
+    # head, copied middle and tail parts, the last command joins them
+    first_keyframe = -(-first_frame // GOP) * GOP
+    last_keyframe = last_frame // GOP * GOP
+    bounds = [first_frame, first_keyframe, last_keyframe, last_frame]
+    bounds = [b for i, b in enumerate(bounds) if i == 0 or b > bounds[i - 1]]
+    assert len(commands) == len(bounds)
+    cut_frames = []
+    for argv, part_first, part_last in zip(commands, bounds, bounds[1:]):
+        run(argv, check=True)
+        part_frames = source_frames(decode(argv[-2]), frames)
+        assert part_frames == list(range(part_first, part_last))
+        cut_frames += part_frames
+    assert cut_frames == list(range(first_frame, last_frame))
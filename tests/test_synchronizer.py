@@ -0,0 +1,112 @@
+from contextlib import closing
+
+import numpy as np
+import pytest
+from constants import SYNC_STREAM_SECONDS
+from scipy.signal import butter, fftconvolve, sosfiltfilt
+from Synchronizer import Synchronizer
+
+SAMPLE_RATE = 8000
+
+
+def music(rng, seconds):
+    # decaying notes at random pitches over a noise floor
+    n_samples = seconds * SAMPLE_RATE
+    times = np.arange(n_samples) / SAMPLE_RATE
+    audio = np.zeros(n_samples, np.float32)
+    for _ in range(seconds * 4):
+        start = rng.integers(0, n_samples - SAMPLE_RATE)
+        length = rng.integers(SAMPLE_RATE // 8, SAMPLE_RATE)
+        frequency = rng.uniform(80, 2000)
+        note = np.sin(2 * np.pi * frequency * times[:length])
+        audio[start : start + length] += note * np.exp(-np.arange(length) / (length / 3))
+    audio += 0.1 * rng.standard_normal(n_samples).astype(np.float32)
+    return audio / np.abs(audio).max()
+
+
+def camera_takes(rng, reference, n_takes):
+    # band limited, with another gain and maybe the polarity flipped, and noisy
+    band = butter(4, [200, 3000], btype="band", fs=SAMPLE_RATE, output="sos")
+    for _ in range(n_takes):
+        start = int(rng.integers(0, len(reference) - 60 * SAMPLE_RATE))
+        length = int(rng.integers(20, 60)) * SAMPLE_RATE
+        take = sosfiltfilt(band, reference[start : start + length]).astype(np.float32)
+        take *= np.float32(rng.choice([-1, 1]) * rng.uniform(0.3, 1.5))
+        take += rng.uniform(0.2, 0.5) * rng.standard_normal(length).astype(np.float32)
+        yield start, take
+
+
+@pytest.fixture(scope="module")
+def reference():
+    return music(np.random.default_rng(0), 600)
+
+
+def exact_correlation_offset(reference, take):
+    correlation = np.abs(fftconvolve(take, reference[::-1], mode="full"))
+    return int(np.argmax(correlation)) - (len(reference) - 1)
+
+
+def test_noisy_takes_offsets_match_exact_correlation():
+    # the envelopes of some of these takes peak far from the offset with low confidence
+    rng = np.random.default_rng(0)
+    reference = music(rng, 600)
+    synchronizer = Synchronizer(reference)
+    for start, take in camera_takes(rng, reference, 40):
+        offset, _ = synchronizer.find_audio_offset(take)
+        assert abs(offset + start) <= 2
+        assert offset == exact_correlation_offset(reference, take)
+
+
+@pytest.mark.parametrize("memory_bytes", [1 << 30, 1 << 22, 0])
+def test_block_correlation_matches_exact_correlation(reference, memory_bytes):
+    # small budgets split the lags and the take in many blocks
+    synchronizer = Synchronizer(reference, memory_bytes=memory_bytes)
+    for start, take in camera_takes(np.random.default_rng(1), reference, 3):
+        offset, confidence = synchronizer.find_audio_offset_exact(take)
+        assert offset == exact_correlation_offset(reference, take)
+        assert abs(offset + start) <= 2
+        assert confidence > 1.0
+
+
+def test_clean_take_offsets(reference):
+    take = reference[123456 : 123456 + 10 * SAMPLE_RATE]
+    start_offset, end_offset, confidence = Synchronizer(reference).offsets(take)
+    assert start_offset == -123456
+    assert end_offset == len(reference) - (len(take) - 123456)
+    assert confidence >= 1.5
+
+
+@pytest.mark.parametrize("memory_bytes", [1 << 30, 1 << 18, 0])
+def test_overlap_save_correlation(reference, memory_bytes):
+    # large budgets correlate in a single block, small ones in many
+    synchronizer = Synchronizer(reference, memory_bytes=memory_bytes)
+    target_envelope = synchronizer.envelope(reference[400000 : 400000 + 30 * SAMPLE_RATE])
+    correlation = synchronizer.envelope_correlation(target_envelope)
+    expected = fftconvolve(target_envelope, synchronizer.reference_envelope[::-1], mode="full")
+    assert correlation.shape == expected.shape
+    assert np.allclose(correlation, expected, atol=1e-3 * np.abs(expected).max())
+
+
+def test_stream_stops_once_two_searches_agree(reference):
+    take = reference[200000 : 200000 + 120 * SAMPLE_RATE]
+    synchronizer = Synchronizer(reference)
+    n_yielded = 0
+    closed = False
+
+    def chunks():
+        nonlocal n_yielded, closed
+        try:
+            for start in range(0, len(take), SAMPLE_RATE):
+                n_yielded += 1
+                yield take[start : start + SAMPLE_RATE]
+        finally:
+            closed = True
+
+    with closing(chunks()) as stream:
+        offsets = synchronizer.offsets_stream(stream, len(take))
+    # searches after 10 and 20 seconds find the same offset
+    assert n_yielded == 2 * SYNC_STREAM_SECONDS
+    assert closed
+    assert offsets[:2] == synchronizer.offsets(take)[:2]
+    assert offsets[0] == -200000
+    assert offsets[1] == len(reference) - (len(take) - 200000)
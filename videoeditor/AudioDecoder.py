@@ -0,0 +1,109 @@
+from math import ceil
+from subprocess import PIPE, CalledProcessError, Popen
+
+import numpy as np
+from constants import NORM_SR
+
+
+class AudioDecoder:
+    """
+    Decode the audio stream of any mediafile to mono s16le PCM through an ffmpeg pipe,
+    straight into a numpy array.
+    """
+
+    def __init__(
+        self,
+        sample_rate: int = int(NORM_SR),
+    ) -> None:
+        self.sample_rate = sample_rate
+
+    def _command(
+        self,
+        i_path: str,
+    ) -> list[str]:
+        return [
+            "ffmpeg",
+            "-loglevel",
+            "error",
+            "-i",
+            i_path,
+            "-vn",  # Disable video processing
+            "-f",
+            "s16le",
+            "-acodec",
+            "pcm_s16le",
+            "-ar",
+            str(self.sample_rate),
+            "-ac",
+            "1",
+            "pipe:1",
+        ]
+
+    def decode(
+        self,
+        i_path: str,
+        duration: float = 0.0,
+        dtype: type = np.float64,
+    ) -> np.ndarray:
+        """
+        Return the samples scaled to [-1, 1) as dtype. duration (in seconds) is used to
+        preallocate the buffer, it grows if the stream turns out to be longer.
+        """
+        samples = np.empty(ceil((duration + 1.0) * self.sample_rate), dtype=np.int16)
+        n_bytes = 0
+        process = Popen(self._command(i_path), stdout=PIPE, stderr=PIPE)
+        while True:
+            if n_bytes == samples.nbytes:
+                samples = np.resize(samples, samples.size * 2)
+            view = memoryview(samples).cast("B")
+            n_read = process.stdout.readinto(view[n_bytes:])
+            if not n_read:
+                break
+            n_bytes += n_read
+        stderr = process.stderr.read()
+        if process.wait() != 0:
+            raise CalledProcessError(process.returncode, process.args, stderr=stderr)
+        audio = samples[: n_bytes // 2].astype(dtype)
+        audio /= 32768.0
+        return audio
+
+    def stream(
+        self,
+        i_path: str,
+        chunk_seconds: float = 1.0,
+        dtype: type = np.float64,
+    ):
+        """
+        Yield the samples scaled to [-1, 1) chunk by chunk, as ffmpeg decodes them. Closing
+        the generator before the end of the stream stops ffmpeg.
+        """
+        chunk = np.empty(max(1, int(chunk_seconds * self.sample_rate)), dtype=np.int16)
+        view = memoryview(chunk).cast("B")
+        process = Popen(self._command(i_path), stdout=PIPE, stderr=PIPE)
+        try:
+            while True:
+                n_bytes = 0
+                while n_bytes < len(view):
+                    n_read = process.stdout.readinto(view[n_bytes:])
+                    if not n_read:
+                        break
+                    n_bytes += n_read
+                if n_bytes:
+                    audio = chunk[: n_bytes // 2].astype(dtype)
+                    audio /= 32768.0
+                    yield audio
+                if n_bytes < len(view):
+                    break
+            stderr = process.stderr.read()
+            if process.wait() != 0:
+                raise CalledProcessError(process.returncode, process.args, stderr=stderr)
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            process.stderr.close()
+
+
+if __name__ == "__main__":
+    pass
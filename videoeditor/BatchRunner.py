@@ -0,0 +1,178 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from json import load
+from logging import DEBUG, INFO, basicConfig, error, info
+from multiprocessing import get_context
+from os import environ, makedirs
+from os.path import dirname, exists, join
+from time import perf_counter
+
+from constants import CPU_BUDGET, CPU_BUDGET_ENV, LOGGING_FORMAT
+from IntermediateCache import IntermediateCache
+from JsonCache import JsonCache
+
+
+def init_worker(
+    debug: bool,
+) -> None:
+    basicConfig(level=DEBUG if debug else INFO, format=LOGGING_FORMAT)
+
+
+@contextmanager
+def worker_environ(
+    name: str,
+    value: str,
+):
+    """
+    Set an environment variable for the processes started within, and restore it after
+    """
+    previous = environ.get(name)
+    environ[name] = value
+    try:
+        yield
+    finally:
+        if previous is None:
+            del environ[name]
+        else:
+            environ[name] = previous
+
+
+def render_job(
+    job: dict,
+    options: dict,
+) -> float:
+    """
+    Render one job of a batch in a worker process, return the seconds it took
+    """
+    # imported here so the worker pays the import cost once, not the batch process
+    from VideoEditor import VideoEditor
+
+    start_time = perf_counter()
+    makedirs(dirname(job["output"]), exist_ok=True)
+    cache = (
+        IntermediateCache(options["cache_dir"], options["cache_size"])
+        if options["cache_dir"]
+        else None
+    )
+    with VideoEditor(
+        job["folder"],
+        start=job.get("start", options["start"]),
+        video_duration=job.get("duration", options["duration"]),
+        encode_profile=job.get("profile", options["encode_profile"]),
+        time_budget=None if options["dry_run"] else options["time_budget"],
+        cache=cache,
+        normalize=options["normalize"],
+        scratch_tiers=options["scratch_tiers"],
+        sync_memory_bytes=options["sync_memory_bytes"],
+        sync_engine=options["sync_engine"],
+        sync_refine=options["sync_refine"],
+        sync_stream=options["sync_stream"],
+        preview=options["preview"],
+    ) as video_editor:
+        video_editor.create_video(
+            options["backend"],
+            job["output"],
+            options["render_workers"],
+            video_editor.plan_segments(job.get("seed", options["seed"])),
+            options["dry_run"],
+        )
+    return perf_counter() - start_time
+
+
+class BatchRunner:
+    """
+    Render the jobs of a json manifest in a pool of worker processes that share the cpu
+    budget. The state of every job is kept next to the manifest, so running an interrupted
+    batch again only renders the jobs that didn't finish.
+    """
+
+    def __init__(
+        self,
+        manifest_path: str,
+        options: dict,
+        workers: int = 2,
+        cpu_budget: int = CPU_BUDGET,
+    ) -> None:
+        self.manifest_path = manifest_path
+        self.workers = max(1, workers)
+        self.cpu_budget = max(1, cpu_budget)
+        self.options = options
+        self.jobs = self._read_manifest()
+        self.state = JsonCache(manifest_path + ".state.json")
+
+    def _read_manifest(
+        self,
+    ) -> list[dict]:
+        with open(self.manifest_path) as f:
+            jobs = load(f)
+        manifest_folder = dirname(self.manifest_path)
+        for job in jobs:
+            # relative paths are relative to the manifest
+            job["folder"] = join(manifest_folder, job["folder"])
+            job["output"] = join(manifest_folder, job["output"])
+        return jobs
+
+    @staticmethod
+    def job_key(
+        job: dict,
+    ) -> str:
+        return IntermediateCache.key(job)
+
+    def pending_jobs(
+        self,
+    ) -> list[dict]:
+        pending = []
+        for job in self.jobs:
+            state = self.state.get(self.job_key(job))
+            if state and state["status"] == "done" and exists(job["output"]):
+                continue
+            pending.append(job)
+        return pending
+
+    def run(
+        self,
+    ) -> bool:
+        """
+        Return whether every job of the manifest is done
+        """
+        jobs = self.pending_jobs()
+        info(f"{len(self.jobs) - len(jobs)} of {len(self.jobs)} jobs already done")
+        if not jobs:
+            return True
+        n_workers = min(self.workers, len(jobs))
+        n_failed = 0
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=get_context("spawn"),
+            initializer=init_worker,
+            initargs=(self.options.get("debug", False),),
+        ) as executor:
+            # spawned workers start on the first submit and read their share of the budget
+            # when importing constants
+            with worker_environ(CPU_BUDGET_ENV, str(max(1, self.cpu_budget // n_workers))):
+                futures = {executor.submit(render_job, job, self.options): job for job in jobs}
+            try:
+                for future in as_completed(futures):
+                    job = futures[future]
+                    try:
+                        elapsed = future.result()
+                        self.state.set(
+                            self.job_key(job), {"status": "done", "elapsed": elapsed}
+                        )
+                        info(f"Rendered {job['output']} in {elapsed:.1f}s")
+                    except Exception as e:
+                        n_failed += 1
+                        self.state.set(
+                            self.job_key(job), {"status": "failed", "error": str(e)}
+                        )
+                        error(f"Job {job['folder']} -> {job['output']} failed: {e}")
+                    self.state.save()
+            except KeyboardInterrupt:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+        info(f"{len(jobs) - n_failed} of {len(jobs)} pending jobs rendered")
+        return n_failed == 0
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,52 @@
+from hashlib import sha256
+from os.path import getsize
+
+from JsonCache import JsonCache
+
+
+class ContentHashes:
+    """
+    Content hashes of files kept in a json file, remembered while the file size and mtime
+    do not change. The intermediate cache and the sync index key their entries on them.
+    """
+
+    HASH_BLOCK_SIZE = 1 << 20
+
+    def __init__(
+        self,
+        path: str,
+    ) -> None:
+        self.hashes = JsonCache(path)
+
+    @staticmethod
+    def sampled_hash(
+        path: str,
+    ) -> str:
+        """
+        Hash of the size and of blocks sampled at the start, middle and end of the file,
+        reading whole videos on every run would cost more than what the cache saves.
+        """
+        size = getsize(path)
+        content = sha256(str(size).encode())
+        block_size = ContentHashes.HASH_BLOCK_SIZE
+        with open(path, "rb") as f:
+            for offset in (0, size // 2, max(0, size - block_size)):
+                f.seek(offset)
+                content.update(f.read(block_size))
+        return content.hexdigest()
+
+    def get(
+        self,
+        path: str,
+    ) -> str:
+        file_key = JsonCache.file_key(path)
+        content_hash = self.hashes.get(file_key)
+        if content_hash is None:
+            content_hash = self.sampled_hash(path)
+            self.hashes.set(file_key, content_hash)
+            self.hashes.save()
+        return content_hash
+
+
+if __name__ == "__main__":
+    pass
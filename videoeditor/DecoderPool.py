@@ -0,0 +1,213 @@
+from collections import OrderedDict
+from logging import debug
+from subprocess import DEVNULL, PIPE, Popen
+
+import numpy as np
+from constants import DECODER_MAX_GRAB, DECODER_POOL_SIZE, FFMPEG_THREADS
+from cv2 import COLOR_YUV2BGR_I420, cvtColor, resize
+from FrameIndex import FrameTimes
+
+
+class VideoReader:
+    """
+    Frames of a video decoded by an ffmpeg process, cropped to crop_rect from the top left
+    corner and scaled to out_size. Crops larger than out_size are scaled down by ffmpeg, so
+    full resolution frames never reach python, smaller ones are scaled up by opencv, which
+    is faster at it. The process is started at the frame read, and again to go back or far
+    ahead.
+    """
+
+    def __init__(
+        self,
+        video_path: str,
+        frame_pts: np.ndarray,
+        keyframe_idxs: np.ndarray,
+        crop_rect: tuple[int, int],
+        out_size: tuple[int, int],
+    ) -> None:
+        self.video_path = video_path
+        # frame presentation times relative to the first frame
+        self.frame_pts = frame_pts
+        self.keyframe_idxs = keyframe_idxs
+        crop_width, crop_height = crop_rect
+        out_width, out_height = out_size
+        # yuv420p frames have even sizes
+        crop_width, crop_height = crop_width // 2 * 2, crop_height // 2 * 2
+        self.video_filter = f"crop={crop_width}:{crop_height}:0:0"
+        self.out_size = None
+        if crop_width * crop_height > out_width * out_height:
+            self.video_filter += f",scale={out_width}:{out_height}:flags=bilinear"
+            crop_width, crop_height = out_size
+        elif (crop_width, crop_height) != out_size:
+            self.out_size = out_size
+        # frames go through the pipe as yuv420p, half the bytes of bgr, and only the frames
+        # read are converted
+        self.frame_shape = (crop_height * 3 // 2, crop_width)
+        self.process = None
+        # index of the next frame in the pipe
+        self.position = 0
+        # last frame read, shown again when the output frame rate is higher
+        self.frame = None
+
+    def _start(
+        self,
+        frame_idx: int,
+    ) -> None:
+        self.release()
+        seek = FrameTimes.seek_time(self.frame_pts, frame_idx)
+        argv = [
+            "ffmpeg",
+            "-loglevel",
+            "error",
+            "-ss",
+            "{:.6f}".format(seek),
+            "-i",
+            self.video_path,
+            "-an",
+            "-vf",
+            self.video_filter,
+            "-fps_mode",
+            "passthrough",  # every frame once, whatever the frame rate
+            "-threads",
+            str(FFMPEG_THREADS),
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "yuv420p",
+            "pipe:1",
+        ]
+        debug(" ".join(argv))
+        self.process = Popen(argv, stdout=PIPE, stderr=DEVNULL)
+        self.position = frame_idx
+
+    def _next(
+        self,
+    ) -> np.ndarray:
+        # the next frame in the pipe, None at the end of the video
+        frame = np.empty(self.frame_shape, np.uint8)
+        view = memoryview(frame).cast("B")
+        n_bytes = 0
+        while n_bytes < len(view):
+            n_read = self.process.stdout.readinto(view[n_bytes:])
+            if not n_read:
+                return None
+            n_bytes += n_read
+        self.position += 1
+        return frame
+
+    def read(
+        self,
+        frame_idx: int,
+        max_grab: int,
+    ) -> np.ndarray:
+        """
+        Return the frame or None if it can't be read. Frames up to max_grab ahead are
+        reached reading the frames in between, unless there is a keyframe in between: then
+        seeking decodes less, and ffmpeg drops the frames before the seek unfiltered.
+        Further frames and previous ones are seeked.
+        """
+        if frame_idx == self.position - 1 and self.frame is not None:
+            return self.frame
+        keyframes_ahead = np.searchsorted(
+            self.keyframe_idxs, [self.position, frame_idx], "right"
+        )
+        if (
+            self.process is None
+            or frame_idx < self.position
+            or frame_idx - self.position > max_grab
+            or keyframes_ahead[1] > keyframes_ahead[0]
+        ):
+            self._start(frame_idx)
+        frame = None
+        while self.position <= frame_idx:
+            frame = self._next()
+            if frame is None:
+                break
+        if frame is not None:
+            frame = cvtColor(frame, COLOR_YUV2BGR_I420)
+            if self.out_size is not None:
+                frame = resize(frame, self.out_size)
+        self.frame = frame
+        return self.frame
+
+    def release(
+        self,
+    ) -> None:
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process.stdout.close()
+            self.process = None
+
+
+class DecoderPool:
+    """
+    Readers of the videos kept open across segments, so a video shown again continues from
+    where it was instead of being opened and seeked. At most max_open readers are open, the
+    least recently used one is closed to open another.
+    """
+
+    def __init__(
+        self,
+        video_paths: list[str],
+        frame_pts: list[np.ndarray],
+        keyframe_idxs: list[np.ndarray],
+        crop_rects: list[tuple[int, int]],
+        out_size: tuple[int, int],
+        max_open: int = DECODER_POOL_SIZE,
+        max_grab: int = DECODER_MAX_GRAB,
+    ) -> None:
+        self.video_paths = video_paths
+        self.frame_pts = frame_pts
+        self.keyframe_idxs = keyframe_idxs
+        # (width, height) of the top left crop of each video, scaled to out_size
+        self.crop_rects = crop_rects
+        self.out_size = out_size
+        self.max_open = max(1, max_open)
+        self.max_grab = max_grab
+        self.readers = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def _reader(
+        self,
+        video_idx: int,
+    ) -> VideoReader:
+        if video_idx in self.readers:
+            self.readers.move_to_end(video_idx)
+            return self.readers[video_idx]
+        if len(self.readers) >= self.max_open:
+            evicted_idx, evicted = self.readers.popitem(last=False)
+            debug(f"Closing reader of video {evicted_idx}")
+            evicted.release()
+        reader = VideoReader(
+            self.video_paths[video_idx],
+            self.frame_pts[video_idx],
+            self.keyframe_idxs[video_idx],
+            self.crop_rects[video_idx],
+            self.out_size,
+        )
+        self.readers[video_idx] = reader
+        return reader
+
+    def read(
+        self,
+        video_idx: int,
+        frame_idx: int,
+    ) -> np.ndarray:
+        return self._reader(video_idx).read(frame_idx, self.max_grab)
+
+    def close(
+        self,
+    ) -> None:
+        for reader in self.readers.values():
+            reader.release()
+        self.readers.clear()
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,73 @@
+from json import dump, load
+
+import numpy as np
+
+
+class EditDecisionList:
+    """
+    The segments of an edit as rows of (video index, first frame in the video, first output
+    frame, number of frames), with what is needed to plan it again: the second of the
+    reference audio it starts at, its duration, the names of the videos and the seed.
+    """
+
+    def __init__(
+        self,
+        segments: np.ndarray,
+        start: float,
+        duration: float,
+        video_names: list[str],
+        seed: int,
+    ) -> None:
+        self.segments = np.asarray(segments, dtype=np.int64).reshape(-1, 4)
+        self.start = start
+        self.duration = duration
+        self.video_names = video_names
+        self.seed = seed
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __iter__(self):
+        return (tuple(int(v) for v in segment) for segment in self.segments)
+
+    @property
+    def video_idxs(self) -> np.ndarray:
+        return self.segments[:, 0]
+
+    @property
+    def out_frames(self) -> np.ndarray:
+        return self.segments[:, 2]
+
+    def save(
+        self,
+        path: str,
+    ) -> None:
+        with open(path, "w") as f:
+            dump(
+                {
+                    "start": self.start,
+                    "duration": self.duration,
+                    "videos": self.video_names,
+                    "seed": self.seed,
+                    "segments": self.segments.tolist(),
+                },
+                f,
+            )
+
+    @staticmethod
+    def load(
+        path: str,
+    ) -> "EditDecisionList":
+        with open(path) as f:
+            plan = load(f)
+        return EditDecisionList(
+            plan["segments"],
+            plan["start"],
+            plan["duration"],
+            plan["videos"],
+            plan["seed"],
+        )
+
+
+if __name__ == "__main__":
+    pass
@@ -1,69 +1,294 @@
-import re
-import subprocess
-from logging import debug, error, info
-from time import sleep
+from logging import debug, error, info, warning
+from math import ceil
+from threading import Lock
+from time import perf_counter
+from typing import NamedTuple
 
-from constants import CMD_LIST, NORM_AUDIO_CODEC, NORM_FPS, NORM_SR, NORM_VIDEO_CODEC
+import numpy as np
+from constants import (
+    CALIBRATION_FRAMES,
+    DEFAULT_ENCODE_PROFILE,
+    ENCODE_PROFILES,
+    NORM_AUDIO_CODEC,
+    NORM_FPS,
+    NORM_VIDEO_CODEC,
+    OUT_AUDIO_PARAMETERS,
+    OUT_HEIGHT,
+    OUT_WIDTH,
+    X264_PRESETS,
+)
+from FrameIndex import FrameTimes
+from IntermediateCache import IntermediateCache
+from JobScheduler import JobResult, JobScheduler
+
+
+class OutputJob(NamedTuple):
+    # an argv or a chain of argvs producing o_path, i_paths is None when it isn't cached
+    argvs: list
+    o_path: str
+    i_paths: list[str] | None
 
 
 class FFmpegWrapper:
-    FFMPEG_COMMAND = 'ffmpeg -loglevel error {input} {parameters} "{o_path}" -y'
-    FFMPEG_COMMAND_INSPECT = [
-        "ffmpeg",
-        "-i",
-        "",
-    ]
+    FFMPEG_COMMAND = ["ffmpeg", "-loglevel", "error"]
+    # the resize and crop of the renders, encoded by the preset calibration
+    OUTPUT_FILTER = (
+        f"scale={OUT_WIDTH}:{OUT_HEIGHT}:force_original_aspect_ratio=increase,"
+        f"crop={OUT_WIDTH}:{OUT_HEIGHT}"
+    )
 
     def __init__(
         self,
+        encode_profile: str = DEFAULT_ENCODE_PROFILE,
+        cache: IntermediateCache = None,
     ):
         self.current_command_batch = []
+        self.set_encode_profile(encode_profile)
+        self.cache = cache
+        # cache key of the outputs produced or restored by this wrapper
+        self.output_keys = {}
+        self.lock = Lock()
+
+    def set_encode_profile(
+        self,
+        encode_profile: str,
+    ):
+        self.encode_profile = dict(ENCODE_PROFILES[encode_profile])
+        self.threads = self.encode_profile["threads"]
+        self.scheduler = JobScheduler(threads_per_job=self.threads)
+
+    def encode_parameters(
+        self,
+        preset: str = None,
+    ) -> list[str]:
+        parameters = [
+            "-c:v",
+            NORM_VIDEO_CODEC,
+            "-preset",
+            preset or self.encode_profile["preset"],  # Encoding speed
+            "-crf",
+            self.encode_profile["crf"],  # Constant Rate Factor, lower is higher quality
+        ]
+        if self.encode_profile["tune"]:
+            parameters += ["-tune", self.encode_profile["tune"]]
+        return parameters
+
+    def _calibration_run(
+        self,
+        i_path: str,
+        encode_parameters: list[str],
+    ) -> JobResult:
+        return self.scheduler.run_job(
+            [
+                *self.FFMPEG_COMMAND,
+                "-filter_threads",
+                str(self.threads),
+                "-threads",
+                str(self.threads),
+                "-i",
+                i_path,
+                "-an",
+                "-frames:v",
+                str(CALIBRATION_FRAMES),
+                "-vf",
+                self.OUTPUT_FILTER,
+                *encode_parameters,
+                "-threads",
+                str(self.threads),
+                "-f",
+                "null",
+                "-",
+            ]
+        )
+
+    def calibrate_preset(
+        self,
+        i_path: str,
+        n_frames: int,
+        time_budget: float,
+    ) -> str:
+        """
+        Encode frames of i_path with increasingly slower presets and keep the slowest one that
+        encodes n_frames output frames within what is left of time_budget seconds on this
+        machine. The time of a run without encoding is subtracted from every preset, so the
+        estimates only count the encoder and not starting ffmpeg or decoding.
+        """
+        calibration_start = perf_counter()
+        chosen_preset = None
+        decode = self._calibration_run(i_path, [])
+        for preset in X264_PRESETS:
+            result = self._calibration_run(i_path, self.encode_parameters(preset))
+            if decode.return_code != 0 or result.return_code != 0:
+                error((decode.stderr + result.stderr).strip())
+                return self.encode_profile["preset"]
+            frame_time = max(result.elapsed - decode.elapsed, 0.0) / CALIBRATION_FRAMES
+            estimated_time = n_frames * frame_time
+            remaining_time = time_budget - (perf_counter() - calibration_start)
+            info(f"Preset {preset}: {n_frames} frames in ~{ceil(estimated_time)}s")
+            if estimated_time > remaining_time:
+                break
+            chosen_preset = preset
+        if chosen_preset is None:
+            warning(f"No preset encodes {n_frames} frames within {time_budget}s")
+            chosen_preset = X264_PRESETS[0]
+        info(f"Using preset {chosen_preset}")
+        self.encode_profile["preset"] = chosen_preset
+        return chosen_preset
+
+    def _command(
+        self,
+        parameters: list[str] = [],
+        input_parameters: list[str] = [],
+    ) -> list[str]:
+        # decoders, filters and the encoder of a job all keep to its threads
+        threads = ["-threads", str(self.threads)]
+        input = [*input_parameters, *threads, "-i", self.i_path] if self.i_path != "" else []
+        parameters = [
+            p for arg in parameters for p in ([*threads, arg] if arg == "-i" else [arg])
+        ]
+        return [
+            *self.FFMPEG_COMMAND,
+            "-filter_threads",
+            str(self.threads),
+            *input,
+            *parameters,
+            *threads,
+            self.o_path,
+            "-y",
+        ]
+
+    def _input_key(
+        self,
+        i_path: str,
+    ) -> str:
+        return self.output_keys.get(i_path) or self.cache.content_hashes.get(i_path)
+
+    def add_job(
+        self,
+        job: list,
+        i_paths: list[str],
+        cached: bool = True,
+    ):
+        """
+        Add an argv, or a chain of argvs, producing self.o_path to the current batch. Unless
+        the output is final, the cache is looked up when the batch runs and a job whose
+        inputs and parameters have an entry is restored from it instead.
+        """
+        cached = self.cache is not None and cached
+        self.current_command_batch.append(
+            OutputJob(job, self.o_path, i_paths if cached else None)
+        )
 
     def create_command(
         self,
         parameters: list[str] = [],
+        input_parameters: list[str] = [],
+        extra_i_paths: list[str] = [],
+        cached: bool = True,
     ):
-        input = '-i "{}"'.format(self.i_path) if self.i_path != "" else ""
-        command = self.FFMPEG_COMMAND.format(
-            input=input,
-            parameters=" ".join(parameters),
-            o_path=self.o_path,
+        i_paths = [self.i_path] if self.i_path != "" else []
+        self.add_job(
+            self._command(parameters, input_parameters), i_paths + extra_i_paths, cached
         )
-        debug(command)
-        self.current_command_batch.append(command)
 
-    def run_current_batch(
+    def _cache_key(
+        self,
+        job: OutputJob,
+    ) -> str:
+        # the key can't depend on the temporary folder, only on inputs and parameters
+        out_folder = job.o_path.rsplit("/", 1)[0]
+        input_keys = {p: self._input_key(p) for p in job.i_paths}
+
+        def normalize(arg):
+            for i_path, input_key in input_keys.items():
+                arg = arg.replace(i_path, input_key)
+            return arg.replace(out_folder, "")
+
+        argvs = job.argvs if isinstance(job.argvs[0], list) else [job.argvs]
+        return self.cache.key([[normalize(a) for a in argv] for argv in argvs])
+
+    def _restore(
+        self,
+        jobs: list[OutputJob],
+    ) -> list[tuple[OutputJob, str]]:
+        """
+        Restore the outputs the cache holds and return the jobs left to run with the cache
+        key of their output, None for outputs that are not cached
+        """
+        pending = []
+        for job in jobs:
+            key = None
+            if job.i_paths is not None:
+                key = self._cache_key(job)
+                self.output_keys[job.o_path] = key
+                if self.cache.get_file(key, job.o_path):
+                    continue
+            pending.append((job, key))
+        return pending
+
+    def _report(
         self,
+        jobs: list[tuple[OutputJob, str]],
+        results: list[JobResult],
+    ) -> None:
+        failed = [r for r in results if r.return_code != 0]
+        if self.cache is not None:
+            for (job, key), result in zip(jobs, results):
+                if key is not None and result.return_code == 0:
+                    self.cache.put_file(key, job.o_path)
+            self.cache.evict()
+        for (job, _), result in zip(jobs, results):
+            debug(f"{job.o_path} finished in {result.elapsed:.2f}s ({result.return_code})")
+        if failed:
+            error(f"{len(failed)} of {len(results)} commands completed with an error")
+            for result in failed:
+                error(" ".join(result.argv))
+                error(result.stderr.strip())
+
+    def _run(
+        self,
+        jobs: list[OutputJob],
         n_processes=1,
-    ):
-        MULTIPROCESS_COMMAND = f"cat {CMD_LIST} | xargs -n1 -P{n_processes} sh -c"
-        cmds = "'\n'".join(self.current_command_batch)
-        cmds_str = f"'{cmds}'\n"
-        with open(
-            CMD_LIST,
-            "w",
-        ) as f:
-            f.write(cmds_str)
-        process = subprocess.Popen(
-            [MULTIPROCESS_COMMAND],
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+    ) -> list[JobResult]:
+        pending = self._restore(jobs)
+        results = self.scheduler.run(
+            [job.argvs for job, _ in pending],
+            n_processes=n_processes,
         )
-        # Wait for the subprocess to complete
-        process.wait()
+        self._report(pending, results)
+        return results
 
-        # Check the return code to determine if the subprocess completed successfully
-        return_code = process.returncode
-        if return_code == 0:
+    def run_current_batch(
+        self,
+        n_processes=1,
+    ) -> list[JobResult]:
+        jobs = self.current_command_batch
+        self.current_command_batch = []
+        results = self._run(jobs, n_processes)
+        if all(r.return_code == 0 for r in results):
             info("Batch completed")
+        return results
+
+    def run_command(
+        self,
+        create_command,
+        *args,
+        **kwargs,
+    ) -> list[JobResult]:
+        """
+        Create the command of a single output with one of the command methods and run it right
+        away, without waiting for a batch. Safe to call from several threads, only creating
+        the command holds the lock, cache restores and runs happen in parallel.
+        """
+        with self.lock:
+            batch = self.current_command_batch
             self.current_command_batch = []
-        else:
-            error(f"Subprocess completed with an error (return code: {return_code})")
-            for cmd in self.current_command_batch:
-                error(cmd)
+            create_command(*args, **kwargs)
+            jobs = self.current_command_batch
+            self.current_command_batch = batch
+        return self._run(jobs)
 
-    def to_wav(
+    def to_mp4(
         self,
         i_path: str,
         o_path: str,
@@ -71,29 +296,37 @@ class FFmpegWrapper:
         self.i_path = i_path
         self.o_path = o_path
         parameters = [
-            "-vn",  # Disable video processing
-            "-acodec",
-            NORM_AUDIO_CODEC,
-            "-ar",
-            NORM_SR,
-            "-ac",
-            "1",
+            "-an",  # Disable audio processing
+            *self.encode_parameters(),
+            "-r",
+            NORM_FPS,
         ]
         self.create_command(parameters)
 
-    def to_mp4(
+    def to_proxy(
         self,
         i_path: str,
         o_path: str,
+        crop_rect: tuple[int, int],
+        width: int,
+        height: int,
     ) -> str:
+        """
+        Small copy of a video with the same frames, cropped from the top left corner and
+        scaled, with a keyframe every second so seeking it is cheap
+        """
         self.i_path = i_path
         self.o_path = o_path
+        crop_width, crop_height = crop_rect
         parameters = [
             "-an",  # Disable audio processing
-            "-vcodec",
-            NORM_VIDEO_CODEC,
-            "-r",
+            "-vf",
+            f"crop={crop_width}:{crop_height}:0:0,scale={width}:{height}",
+            *self.encode_parameters(),
+            "-g",
             NORM_FPS,
+            "-fps_mode",
+            "passthrough",  # Keep every frame and its timestamp
         ]
         self.create_command(parameters)
 
@@ -106,9 +339,11 @@ class FFmpegWrapper:
     ) -> str:
         self.i_path = i_path
         self.o_path = o_path
-        parameters = [
+        input_parameters = [
             "-ss",
-            str(start_offset_seconds),  # Set the start offset in seconds
+            str(start_offset_seconds),  # Seek the input to the start offset in seconds
+        ]
+        parameters = [
             "-t",
             str(duration),
             "-acodec",
@@ -118,141 +353,134 @@ class FFmpegWrapper:
             "-ac",
             "2",
         ]
-        self.create_command(parameters)
+        self.create_command(parameters, input_parameters)
+
+    def _cut_video_part(
+        self,
+        o_path: str,
+        start: float,
+        n_frames: int,
+        copy: bool,
+    ) -> list[str]:
+        self.o_path = o_path
+        input_parameters = [
+            "-ss",
+            "{:.6f}".format(start),  # Seek the input to the start offset in seconds
+        ]
+        parameters = [
+            "-frames:v",
+            str(n_frames),
+            "-an",  # Disable audio processing
+            *(["-c:v", "copy"] if copy else self.encode_parameters()),
+        ]
+        return self._command(parameters, input_parameters)
 
     def cut_video(
         self,
         i_path: str,
         o_path: str,
-        start_offset_seconds: int,
-        duration: int,
+        start_offset_seconds: float,
+        duration: float,
+        frame_times: FrameTimes,
+        smart_cut: bool = False,
     ) -> str:
+        """
+        Frame accurate cut seeking the input, start_offset_seconds is counted from its first
+        frame. With smart_cut only the partial GOPs at both ends are re-encoded, the keyframe
+        aligned middle part is copied.
+        """
         self.i_path = i_path
-        self.o_path = o_path
-        parameters = [
-            "-ss",
-            "{:.1f}".format(start_offset_seconds),  # Set the start offset in seconds
-            "-t",
-            "{:.1f}".format(duration),
-            "-c:v",
-            "copy",  # Copy the video codec
-            "-c:a",
-            "copy",  # Copy the audio codec
+        frame_times = frame_times.relative()
+        start = start_offset_seconds
+        end = start_offset_seconds + duration
+        # a frame belongs to the cut if its timestamp is within [start, end), with half a
+        # frame of tolerance for the rounding of the offsets
+        tolerance = float(np.median(np.diff(frame_times.pts))) / 2 if smart_cut else 0.0
+        first_frame, last_frame = np.searchsorted(
+            frame_times.pts, [start - tolerance, end - tolerance]
+        )
+        # the first frame can be before start
+        seek = start
+        if first_frame < len(frame_times.pts):
+            seek = FrameTimes.seek_time(frame_times.pts, first_frame)
+        # keyframes from the first frame of the cut to the first frame after it, which ends
+        # the copied part without a tail
+        keyframe_idxs = np.searchsorted(frame_times.pts, frame_times.keyframes)
+        keyframe_idxs = keyframe_idxs[
+            (keyframe_idxs >= first_frame) & (keyframe_idxs <= last_frame)
         ]
-        self.create_command(parameters)
+        if not smart_cut or len(keyframe_idxs) < 2:
+            self.add_job(
+                self._cut_video_part(o_path, seek, last_frame - first_frame, copy=False),
+                [i_path],
+            )
+            return
+        # (start, first frame index, copy) of each part, ending where the next one starts
+        first_keyframe, last_keyframe = keyframe_idxs[0], keyframe_idxs[-1]
+        parts = [
+            (seek, first_frame, False),
+            # seek a bit past the keyframe so rounding can't land on the previous one
+            (frame_times.pts[first_keyframe] + 0.0005, first_keyframe, True),
+            (FrameTimes.seek_time(frame_times.pts, last_keyframe), last_keyframe, False),
+        ]
+        part_frames = np.diff([p[1] for p in parts] + [last_frame])
+        parts = [
+            (part_start, n_frames, copy)
+            for (part_start, _, copy), n_frames in zip(parts, part_frames)
+            if n_frames > 0
+        ]
+
+        # mpegts parts keep their parameter sets in band, so copied and re-encoded parts can
+        # be joined without re-encoding
+        part_paths = [f"{o_path.rsplit('.', 1)[0]}.part{i}.ts" for i in range(len(parts))]
+        commands = [
+            self._cut_video_part(part_path, *part)
+            for part_path, part in zip(part_paths, parts)
+        ]
+        concat_list_path = o_path + ".lst"
+        with open(concat_list_path, "w") as f:
+            f.writelines(f"file '{p}'\n" for p in part_paths)
+        self.i_path = concat_list_path
+        self.o_path = o_path
+        commands.append(
+            self._command(
+                ["-c", "copy"],
+                ["-f", "concat", "-safe", "0"],
+            )
+        )
+        self.add_job(commands, [i_path])
 
-    def join_video_and_audio(
+    def concat_video_and_audio(
         self,
+        i_v_paths: list[str],
         i_a_path: str,
-        i_v_path: str,
         o_path: str,
     ) -> str:
-        self.i_path = i_v_path
+        """
+        Join videos encoded with the same parameters without re-encoding them, and mux the
+        audio. The list of videos is written next to the first one.
+        """
+        concat_list_path = i_v_paths[0].rsplit(".", 1)[0] + ".lst"
+        with open(concat_list_path, "w") as f:
+            f.writelines(f"file '{p}'\n" for p in i_v_paths)
+        self.i_path = concat_list_path
         self.o_path = o_path
         parameters = [
             "-i",
             i_a_path,
-            "-vf",
-            "scale=1080:1920:force_original_aspect_ratio=increase,crop=1080:1920",  # Resize and crop
+            "-map",
+            "0:v",
+            "-map",
+            "1:a",
             "-c:v",
-            "libx264",  # Video codec (H.264)
-            "-preset",
-            "slow",  # Encoding speed
-            "-crf",
-            "23",  # Constant Rate Factor (0-51, lower is higher quality, 23 is a good default)
-            "-c:a",
-            "aac",  # Audio codec (AAC)
-            "-b:a",
-            "128k",  # Audio bitrate
-            "-ar",
-            "44100",  # Sample rate
-            "-ac",
-            "2",  # Stereo
+            "copy",
+            *OUT_AUDIO_PARAMETERS,
+            "-shortest",
         ]
-        self.create_command(parameters)
-
-    def get_audio_duration(
-        self,
-        i_path,
-    ):
-        retry = True
-        while retry:
-            try:
-                self.FFMPEG_COMMAND_INSPECT[-1] = i_path
-                result = subprocess.run(
-                    self.FFMPEG_COMMAND_INSPECT,
-                    capture_output=True,
-                    text=True,
-                )
-                # Extract the duration from FFmpeg output using regex
-                duration_match = re.findall(
-                    r"Duration: \d+:\d+:\d+\.\d+",
-                    result.stderr,
-                )
-                duration_parts = (
-                    duration_match[0]
-                    .replace(
-                        "Duration: ",
-                        "",
-                    )
-                    .split(":")
-                )
-                audio_duration = (
-                    int(duration_parts[0]) * 3600
-                    + int(duration_parts[1]) * 60
-                    + float(duration_parts[2])
-                )
-                return audio_duration
-            except IndexError:
-                sleep(0.01)
-                continue
-
-    def get_width_height_framerate(
-        self,
-        input_video,
-    ):
-        # Run ffprobe to get resolution and frame rate
-        ffprobe_cmd = [
-            "ffprobe",
-            "-v",
-            "error",
-            "-select_streams",
-            "v:0",
-            "-show_entries",
-            "stream=width,height,r_frame_rate",
-            "-of",
-            "csv=s=x:p=0",
-            input_video,
-        ]
-        ffprobe_output = subprocess.check_output(
-            ffprobe_cmd,
-            text=True,
-        )
-        try:
-            (
-                width,
-                height,
-                frame_rate,
-            ) = ffprobe_output.strip().split("x")
-        except ValueError:
-            (
-                width,
-                height,
-                frame_rate,
-                _,
-            ) = ffprobe_output.strip().split("x")
-        if "/" in frame_rate:
-            (
-                num,
-                den,
-            ) = frame_rate.split("/")
-            frame_rate = float(num) / float(den)
-        else:
-            frame_rate = float(frame_rate)
-        return (
-            int(width),
-            int(height),
-            frame_rate,
+        self.add_job(
+            self._command(parameters, ["-f", "concat", "-safe", "0"]),
+            [*i_v_paths, i_a_path],
+            cached=False,
         )
 
 
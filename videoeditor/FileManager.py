@@ -1,46 +1,93 @@
-from logging import info
-from os import listdir, mkdir
-from os.path import join
-from shutil import rmtree
+from contextlib import closing
+from functools import partial
+from logging import info, warning
+from math import ceil
+from os import listdir, makedirs, replace
+from os.path import exists, getsize, join
+from subprocess import CalledProcessError
+from threading import BoundedSemaphore, Lock
 
+from AudioDecoder import AudioDecoder
 from constants import (
     AUDIO_FOLDER,
-    NORM_AUDIO_FOLDER,
+    BEAT_HOP_LENGTH,
+    CONTENT_HASHES,
+    DEFAULT_ENCODE_PROFILE,
+    FRAME_INDEX_FOLDER,
+    NORM_FPS,
     NORM_SR,
     NORM_VIDEO_FOLDER,
+    PROBE_CACHE,
+    PROXY_FOLDER,
+    SCRATCH_TIERS,
+    SYNC_FINGERPRINT_MIN_CONFIDENCE,
+    SYNC_FINGERPRINT_RATE,
+    SYNC_FINGERPRINT_WINDOW,
+    SYNC_INDEX,
+    SYNC_MEMORY_BYTES,
+    SYNC_MIN_CONFIDENCE,
     VIDEO_FOLDER,
     VIDEO_SYNC_FOLDER,
 )
+from ContentHashes import ContentHashes
 from cv2 import imwrite
 from FfmpegWraper import FFmpegWrapper
-from numpy import uint8, zeros
+from FingerprintSynchronizer import Fingerprint, FingerprintSynchronizer
+from FrameIndex import FrameIndex, FrameTimes
+from IntermediateCache import IntermediateCache
+from IOStats import IOStats
+from JobScheduler import TaskGraph
+from MediaProbe import MediaProbe
+from MultiTake import MultiTake
+from numpy import float32, ndarray, uint8, zeros
+from ScratchStorage import ScratchStorage
 from Synchronizer import Synchronizer
-from tempfile import mkdtemp
+from SyncIndex import SyncIndex
 
 
 class FileManager:
     def __init__(
         self,
         base_folder,
+        encode_profile=DEFAULT_ENCODE_PROFILE,
+        cache: IntermediateCache = None,
+        scratch_tiers: dict[str, list[str]] = SCRATCH_TIERS,
+        sync_memory_bytes: int = SYNC_MEMORY_BYTES,
+        sync_engine: str = "waveform",
+        sync_refine: bool = False,
+        sync_stream: bool = False,
     ) -> None:
         self.base_folder = base_folder
-        self.temp_folder = mkdtemp(dir=self.base_folder)
+        self.sync_memory_bytes = sync_memory_bytes
+        self.sync_engine = sync_engine
+        # refine fingerprint offsets on the waveforms
+        self.sync_refine = sync_refine
+        # decode only as much video audio as needed to find the waveform offsets
+        self.sync_stream = sync_stream
+        self.cache = cache
+        self.scratch = ScratchStorage(self.base_folder, scratch_tiers)
+        self.io_stats = IOStats()
         self.audio_filepath = self._get_filepaths(AUDIO_FOLDER)[0]
         self.video_filepaths = sorted(self._get_filepaths(VIDEO_FOLDER))
-        self.ffmpeg_commands = FFmpegWrapper()
-        self.videos_resolution = [
-            self.ffmpeg_commands.get_width_height_framerate(p) for p in self.video_filepaths
-        ]
-        self.audio_duration = self.ffmpeg_commands.get_audio_duration(self.audio_filepath)
+        self.ffmpeg_commands = FFmpegWrapper(encode_profile, cache)
+        self.media_probe = MediaProbe(join(self.base_folder, PROBE_CACHE))
+        media_info = self.media_probe.probe_all(self.video_filepaths + [self.audio_filepath])
+        self.videos_info = media_info[:-1]
+        self.audio_duration = media_info[-1].duration
+        self.audio_decoder = AudioDecoder()
+        self.frame_index = FrameIndex(join(self.base_folder, FRAME_INDEX_FOLDER))
+        # the cache hashes are shared by all projects, without it they are kept in the project
+        self.content_hashes = (
+            ContentHashes(join(self.base_folder, CONTENT_HASHES))
+            if cache is None
+            else cache.content_hashes
+        )
+        self.sync_index = SyncIndex(join(self.base_folder, SYNC_INDEX), self.content_hashes)
 
     def remove_tmp_folder_and_contents(
         self,
     ):
-        try:
-            rmtree(self.temp_folder)
-            info(f"Folder '{self.temp_folder}' and its contents have been removed.")
-        except Exception as e:
-            info(f"An error occurred: {e}")
+        self.scratch.cleanup()
 
     def _get_filepaths(
         self,
@@ -60,147 +107,433 @@ class FileManager:
             )
         ]
 
+    def calibrate_encoder(
+        self,
+        duration: float,
+        time_budget: float,
+        normalize: bool = False,
+    ) -> None:
+        """
+        Pick the slowest preset that encodes every video of the run within time_budget seconds
+        """
+        n_videos = len(self.video_filepaths)
+        n_parallel = self.ffmpeg_commands.scheduler.max_workers(n_videos)
+        # normalized videos are encoded in rounds of n_parallel, then the output video
+        n_rounds = 1 + ceil(n_videos / n_parallel) if normalize else 1
+        n_frames = int(duration * float(NORM_FPS)) * n_rounds
+        self.ffmpeg_commands.calibrate_preset(
+            self.video_filepaths[0],
+            n_frames,
+            time_budget,
+        )
+
     def set_offsets(
         self,
-        offsets: list[int],
+        offsets: list[tuple[int, int, float]],
     ) -> None:
         # convert from sample number to second.ms
         self.start_offsets = [o[0] / int(NORM_SR) for o in offsets]
         self.finish_offsets = [o[1] / int(NORM_SR) for o in offsets]
+        self.sync_confidences = [o[2] for o in offsets]
+
+    def _output_path(
+        self,
+        kind: str,
+        folder_name: str,
+        input_path: str,
+        extension: str,
+        n_bytes: int = 0,
+    ) -> str:
+        """
+        Path of an intermediate file of about n_bytes in the scratch storage of its kind
+        """
+        return join(
+            self.scratch.folder(kind, folder_name, n_bytes),
+            input_path.split("/")[-1].rsplit(
+                ".",
+                1,
+            )[0]
+            + extension,
+        )
+
+    def sync_audio_key(
+        self,
+        input_path: str,
+    ) -> str:
+        if self.cache is None:
+            return input_path
+        return self.cache.key(
+            self.content_hashes.get(input_path),
+            "sync_audio",
+            self.audio_decoder.sample_rate,
+            "float32",
+        )
+
+    def load_sync_audio(
+        self,
+        input_path: str,
+        duration: float,
+    ) -> tuple[str, ndarray]:
+        """
+        Decode the audio of a video or of the reference audio for synch purposes.
+        Return the cache key of the decoded audio and the audio.
+        """
+        key = self.sync_audio_key(input_path)
+        audio = None if self.cache is None else self.cache.get_array(key)
+        if audio is None:
+            with self.io_stats.measure("decode_audio", [input_path]):
+                audio = self.audio_decoder.decode(input_path, duration, float32)
+            if self.cache is not None:
+                self.cache.put_array(key, audio)
+                self.cache.evict()
+        return key, audio
+
+    def load_fingerprint(
+        self,
+        input_path: str,
+        duration: float,
+    ) -> Fingerprint:
+        if self.cache is None:
+            _, audio = self.load_sync_audio(input_path, duration)
+            return FingerprintSynchronizer.fingerprint(audio)
+        key = self.cache.key(
+            self.sync_audio_key(input_path),
+            "onsets",
+            SYNC_FINGERPRINT_RATE,
+            SYNC_FINGERPRINT_WINDOW,
+        )
+        # the onsets and the number of samples they come from
+        onsets, n_samples = self.cache.get_array(key), self.cache.get_json(key)
+        if onsets is not None and n_samples is not None:
+            return Fingerprint(onsets, n_samples)
+        _, audio = self.load_sync_audio(input_path, duration)
+        fingerprint = FingerprintSynchronizer.fingerprint(audio)
+        self.cache.put_array(key, fingerprint.onsets)
+        self.cache.put_json(key, fingerprint.n_samples)
+        return fingerprint
+
+    def load_beat_analysis(
+        self,
+    ) -> dict:
+        """
+        Beats and onsets of the whole reference audio, analyzed once and kept in the sync
+        index while the reference audio is unchanged
+        """
+        name = f"beats|{self.audio_decoder.sample_rate}|{BEAT_HOP_LENGTH}"
+        analysis = self.sync_index.get_analysis(self.audio_filepath, name)
+        if analysis is None:
+            info("Tracking beats of the reference audio...")
+            _, audio = self.load_sync_audio(self.audio_filepath, self.audio_duration)
+            analysis = MultiTake.analyze_beats(audio, self.audio_decoder.sample_rate)
+            self.sync_index.set_analysis(self.audio_filepath, name, analysis)
+        return analysis
 
-    def create_normalized_audiofiles(
+    def get_synchronizer(
         self,
-    ) -> list[str]:
+    ):
         """
-        Convert reference audio and reate normalized audio files from video for synch purposes
+        Synchronizer of the reference audio with the sync engine, shared by every video and
+        created when the first video missing from the sync index needs it
         """
-        out_folder = join(self.temp_folder, NORM_AUDIO_FOLDER)
-        mkdir(out_folder)
-        out_paths = []
-        for input_video_path in self.video_filepaths + [self.audio_filepath]:
-            out_path = join(
-                out_folder,
-                input_video_path.split("/")[-1].rsplit(
-                    ".",
-                    1,
-                )[0]
-                + ".wav",
+        with self.synchronizer_lock:
+            if self.synchronizer is None:
+                self.synchronizer = self.create_synchronizer(self.max_video_samples)
+            return self.synchronizer
+
+    def create_synchronizer(
+        self,
+        max_video_samples: int,
+    ):
+        if self.sync_engine == "waveform":
+            _, reference = self.load_sync_audio(self.audio_filepath, self.audio_duration)
+            return Synchronizer(
+                reference,
+                max_target_length=max_video_samples,
+                memory_bytes=self.correlation_bytes,
             )
-            self.ffmpeg_commands.to_wav(
-                input_video_path,
+        refine_synchronizer = None
+        if self.sync_refine:
+            _, reference = self.load_sync_audio(self.audio_filepath, self.audio_duration)
+            refine_synchronizer = Synchronizer(reference, memory_bytes=self.correlation_bytes)
+        return FingerprintSynchronizer(
+            self.load_fingerprint(self.audio_filepath, self.audio_duration),
+            refine_synchronizer=refine_synchronizer,
+        )
+
+    def _synchronize(
+        self,
+        video_path: str,
+        video_duration: float,
+    ) -> list:
+        synchronizer = self.get_synchronizer()
+        # videos are loaded when their turn comes, as many at a time as fit in memory
+        with self.sync_slots:
+            if self.sync_engine == "waveform" and self.sync_stream:
+                n_samples = round(video_duration * self.audio_decoder.sample_rate)
+                n_decoded = 0
+
+                def counted(chunks):
+                    nonlocal n_decoded
+                    for chunk in chunks:
+                        n_decoded += len(chunk)
+                        yield chunk
+
+                with self.io_stats.measure("stream_audio") as read_paths:
+                    with closing(
+                        self.audio_decoder.stream(video_path, dtype=float32)
+                    ) as chunks:
+                        offsets = synchronizer.offsets_stream(counted(chunks), n_samples)
+                    # decoding stops once the offset is found
+                    read_paths.append((video_path, n_decoded / max(1, n_samples)))
+            elif self.sync_engine == "waveform":
+                _, audio = self.load_sync_audio(video_path, video_duration)
+                offsets = synchronizer.offsets(audio)
+            else:
+                fingerprint = self.load_fingerprint(video_path, video_duration)
+                audio = None
+                if self.sync_refine:
+                    _, audio = self.load_sync_audio(video_path, video_duration)
+                offsets = synchronizer.offsets(fingerprint, audio)
+        start_offset, end_offset, confidence = offsets
+        return [int(start_offset), int(end_offset), float(confidence)]
+
+    def compute_offsets(
+        self,
+        video_path: str,
+        video_duration: float,
+    ) -> tuple[int, int, float]:
+        """
+        Return the start and end offsets of a video and the confidence of the match, from
+        the sync index when the video and the reference audio are unchanged
+        """
+        if self.sync_engine == "waveform":
+            # streamed syncs may stop early and take the end offset from the container
+            # duration instead of the decoded audio
+            method = "pyramid_stream" if self.sync_stream else "pyramid"
+            min_confidence = SYNC_MIN_CONFIDENCE
+        else:
+            # fingerprint confidences are peak scores, not ratios between peaks
+            method = "fingerprint_score_refined" if self.sync_refine else "fingerprint_score"
+            min_confidence = SYNC_FINGERPRINT_MIN_CONFIDENCE
+        offsets = self.sync_index.get(self.audio_filepath, video_path, method)
+        if offsets is None:
+            info(f"Synchronizing {video_path}...")
+            offsets = self._synchronize(video_path, video_duration)
+            self.sync_index.set(self.audio_filepath, video_path, method, offsets)
+        if offsets[2] < min_confidence:
+            warning(f"Ambiguous sync of {video_path}, confidence {offsets[2]:.2f}")
+        return tuple(offsets)
+
+    def cut_video_based_on_offsets(
+        self,
+        video_idx: int,
+        offsets: tuple[int, int],
+        start: float,
+        duration: float,
+    ) -> str:
+        """
+        Cut a video from the second where the reference audio is at start to start + duration
+        """
+        video_path = self.video_filepaths[video_idx]
+        video_info = self.videos_info[video_idx]
+        # the cut keeps the source bitrate, twice as much leaves room for the smart cut parts
+        n_bytes = 2 * int(getsize(video_path) * min(1.0, duration / video_info.duration))
+        out_path = self._output_path("video", VIDEO_SYNC_FOLDER, video_path, ".mp4", n_bytes)
+        start_cut = max(
+            0.0,
+            offsets[0] / int(NORM_SR) + start,
+        )
+        frame_times = self.frame_index.get(video_path)
+        # only H.264 parts can be joined with the copied middle of the smart cut
+        with self.io_stats.measure(
+            "cut_video", [(video_path, duration / video_info.duration)], [out_path]
+        ):
+            self.ffmpeg_commands.run_command(
+                self.ffmpeg_commands.cut_video,
+                video_path,
                 out_path,
+                start_cut,
+                duration,
+                frame_times,
+                smart_cut=video_info.video_codec == "h264",
             )
-            out_paths.append(out_path)
-        self.normalized_audiopaths = out_paths
-        n_files = len(out_paths)
-        info(f"Creating {n_files} normalized audiofiles...")
-        self.ffmpeg_commands.run_current_batch(n_processes=n_files)
-
-    def normalize_sync_videofiles(
-        self,
-    ) -> list[str]:
-        """
-        Create copies of all videos normalized
-        """
-        out_folder = join(self.temp_folder, NORM_VIDEO_FOLDER)
-        mkdir(out_folder)
-        out_paths = []
-        for input_video_path in self.sync_videopaths:
-            out_path = join(
-                out_folder,
-                input_video_path.split("/")[-1].rsplit(
-                    ".",
-                    1,
-                )[0]
-                + ".mp4",
-            )
-            self.ffmpeg_commands.to_mp4(
+        return out_path
+
+    def normalize_sync_videofile(
+        self,
+        input_video_path: str,
+    ) -> str:
+        """
+        Create a normalized copy of a video
+        """
+        out_path = self._output_path(
+            "video", NORM_VIDEO_FOLDER, input_video_path, ".mp4", 2 * getsize(input_video_path)
+        )
+        with self.io_stats.measure("normalize_video", [input_video_path], [out_path]):
+            self.ffmpeg_commands.run_command(
+                self.ffmpeg_commands.to_mp4,
                 input_video_path,
                 out_path,
             )
-            out_paths.append(out_path)
-        self.normalized_videopaths = out_paths
-        n_files = len(out_paths)
-        info(f"Creating {n_files} normalized sync videofiles...")
-        self.ffmpeg_commands.run_current_batch(n_processes=n_files)
+        return out_path
 
     def cut_audio_based_on_offsets(
         self,
-        out_folder,
-        start: int,
-        duration: int,
-    ):
+        start: float,
+        duration: float,
+    ) -> str:
         # Manage audio crop and get final duration
-        audio_out_path = join(
-            out_folder,
-            self.audio_filepath.split("/")[-1].rsplit(
-                ".",
-                1,
-            )[0]
-            + ".wav",
+        # 16 bit stereo pcm at 44.1kHz
+        audio_out_path = self._output_path(
+            "audio", VIDEO_SYNC_FOLDER, self.audio_filepath, ".wav", int(duration * 44100 * 4)
         )
-        self.ffmpeg_commands.cut_audio(
-            self.audio_filepath,
-            audio_out_path,
-            start,
-            duration,
-        )
-        self.sync_audiopath = audio_out_path
-        info(f"Cut sync audiofile...")
-        self.ffmpeg_commands.run_current_batch(n_processes=1)
-        self.audio_cut_duration = self.ffmpeg_commands.get_audio_duration(audio_out_path)
+        with self.io_stats.measure(
+            "cut_audio",
+            [(self.audio_filepath, duration / self.audio_duration)],
+            [audio_out_path],
+        ):
+            self.ffmpeg_commands.run_command(
+                self.ffmpeg_commands.cut_audio,
+                self.audio_filepath,
+                audio_out_path,
+                start,
+                duration,
+            )
+        self.audio_cut_duration = max(0.0, min(duration, self.audio_duration - start))
+        return audio_out_path
 
-    def cut_videos_based_on_offsets(
+    def create_proxies(
         self,
-        start: int,
-        duration: int,
-    ):
+        crop_rects: list[tuple[int, int]],
+        width: int,
+        height: int,
+    ) -> tuple[list[str], list[FrameTimes]]:
         """
-        cut audio from start to start + duration
-        compute seconds where each video is present in relation to video and cut
+        Return the paths and frame times of proxies of the videos, kept in the project folder
+        by content hash and created the first time they are needed
+        """
+        proxy_folder = join(self.base_folder, PROXY_FOLDER)
+        makedirs(proxy_folder, exist_ok=True)
+        proxy_paths = [
+            join(proxy_folder, f"{self.content_hashes.get(path)}_{width}x{height}.mp4")
+            for path in self.video_filepaths
+        ]
+        missing = [
+            (video_path, proxy_path, crop_rect)
+            for video_path, proxy_path, crop_rect in zip(
+                self.video_filepaths, proxy_paths, crop_rects
+            )
+            if not exists(proxy_path)
+        ]
+        if missing:
+            info(f"Creating proxies of {len(missing)} videofiles...")
+            for video_path, proxy_path, crop_rect in missing:
+                # written aside, so an interrupted proxy is never used
+                self.ffmpeg_commands.to_proxy(
+                    video_path, proxy_path + ".tmp.mp4", crop_rect, width, height
+                )
+            with self.io_stats.measure(
+                "create_proxies",
+                [m[0] for m in missing],
+                [m[1] + ".tmp.mp4" for m in missing],
+            ):
+                results = self.ffmpeg_commands.run_current_batch(n_processes=len(missing))
+            for result in results:
+                if result.return_code != 0:
+                    raise CalledProcessError(
+                        result.return_code, result.argv, stderr=result.stderr
+                    )
+            for _, proxy_path, _ in missing:
+                replace(proxy_path + ".tmp.mp4", proxy_path)
+        self.sync_index.save()
+        return proxy_paths, [self.frame_index.get(path) for path in proxy_paths]
 
+    def process_videos(
+        self,
+        start: float,
+        duration: float,
+        normalize: bool = False,
+    ):
+        """
+        Synchronize every video as a graph of per video tasks, so each step of a video starts
+        as soon as its own previous step is done. Videos are rendered straight from the
+        original files through their frame index, unless normalize is set: then they are cut
+        and re-encoded to a constant frame rate first.
         """
-        synchronizer = Synchronizer(self.normalized_audiopaths)
-        self.set_offsets(synchronizer.run())
-        out_folder = join(self.temp_folder, VIDEO_SYNC_FOLDER)
-        mkdir(out_folder)
-        self.cut_audio_based_on_offsets(
-            out_folder,
-            start,
-            duration,
+        graph = TaskGraph()
+        max_video_samples = ceil(max(i.duration for i in self.videos_info) * int(NORM_SR))
+        self.max_video_samples = max_video_samples
+        self.synchronizer = None
+        self.synchronizer_lock = Lock()
+        # a video takes 2 bytes per sample while decoding, 4 as float32 and about 1 more for
+        # its decimated copies, the reference is held all along and a quarter of the memory
+        # is left to the full correlation of ambiguous videos, which runs one at a time
+        reference_bytes = 5 * ceil(self.audio_duration * int(NORM_SR))
+        self.correlation_bytes = self.sync_memory_bytes // 4
+        n_slots = (self.sync_memory_bytes - reference_bytes - self.correlation_bytes) // (
+            7 * max_video_samples
         )
-
-        videos_out_path = []
-        for (
-            video_path,
-            start_offset,
-        ) in zip(
-            self.video_filepaths,
-            self.start_offsets,
+        self.sync_slots = BoundedSemaphore(max(1, n_slots))
+        graph.add("sync_audio", partial(self.cut_audio_based_on_offsets, start, duration))
+        graph.add("beats", self.load_beat_analysis)
+        for video_idx, (video_path, video_info) in enumerate(
+            zip(self.video_filepaths, self.videos_info)
         ):
-            out_path = join(
-                out_folder,
-                video_path.split("/")[-1].rsplit(
-                    ".",
-                    1,
-                )[0]
-                + ".mp4",
+            graph.add(
+                f"offsets_{video_idx}",
+                partial(self.compute_offsets, video_path, video_info.duration),
             )
-            start_cut = max(
-                0.0,
-                start_offset + start,
+            if not normalize:
+                graph.add(
+                    f"frame_times_{video_idx}", partial(self.frame_index.get, video_path)
+                )
+                continue
+            graph.add(
+                f"cut_{video_idx}",
+                partial(
+                    self.cut_video_based_on_offsets, video_idx, start=start, duration=duration
+                ),
+                [f"offsets_{video_idx}"],
             )
-            self.ffmpeg_commands.cut_video(
-                video_path,
-                out_path,
-                start_cut,
-                duration,
+            graph.add(
+                f"normalized_{video_idx}",
+                self.normalize_sync_videofile,
+                [f"cut_{video_idx}"],
             )
-            videos_out_path.append(out_path)
-        n_files = len(videos_out_path)
-        info(f"Cutting {n_files} videofiles...")
-        self.ffmpeg_commands.run_current_batch(n_processes=n_files)
-        self.sync_videopaths = videos_out_path
+            graph.add(
+                f"frame_times_{video_idx}",
+                partial(self.frame_index.get, cache=False),
+                [f"normalized_{video_idx}"],
+            )
+        info(f"Processing {len(self.video_filepaths)} videofiles...")
+        try:
+            results = graph.run()
+        finally:
+            # keep the offsets found even if another video failed
+            self.sync_index.save()
+
+        n_videos = len(self.video_filepaths)
+        self.set_offsets([results[f"offsets_{i}"] for i in range(n_videos)])
+        self.sync_audiopath = results["sync_audio"]
+        # beats within the cut, from its start
+        self.render_beat_times = [
+            b - start for b in results["beats"]["beats"] if start <= b < start + duration
+        ]
+        self.render_frame_times = [results[f"frame_times_{i}"] for i in range(n_videos)]
+        if normalize:
+            self.render_videopaths = [results[f"normalized_{i}"] for i in range(n_videos)]
+            # normalized videos keep the source resolution at a constant frame rate
+            self.render_videos_metadata = [
+                (i.width, i.height, float(NORM_FPS)) for i in self.videos_info
+            ]
+            # and start at the cut second instead of the video start
+            self.render_time_offsets = [o - max(0.0, o + start) for o in self.start_offsets]
+        else:
+            self.render_videopaths = self.video_filepaths
+            self.render_videos_metadata = [
+                (i.width, i.height, i.frame_rate) for i in self.videos_info
+            ]
+            self.render_time_offsets = self.start_offsets
         return (
             self.start_offsets,
             self.finish_offsets,
@@ -225,20 +558,6 @@ class FileManager:
             black_image,
         )
 
-    def video_audio_to_instavideo(
-        self,
-        input_audio_path,
-        input_video_path,
-        output_video_path,
-    ):
-        info("Joining video and audio...")
-        self.ffmpeg_commands.join_video_and_audio(
-            input_audio_path,
-            input_video_path,
-            output_video_path,
-        )
-        self.ffmpeg_commands.run_current_batch()
-
 
 if __name__ == "__main__":
     pass
@@ -0,0 +1,126 @@
+from logging import info
+from subprocess import CalledProcessError
+
+import numpy as np
+from constants import OUT_AUDIO_PARAMETERS
+from FrameIndex import FrameTimes
+from JobScheduler import JobScheduler
+
+
+class FilterGraphRenderer:
+    """
+    Render a sequence of segments with a single ffmpeg filter_complex: every segment is
+    trimmed from the input of its video, cropped, scaled and concatenated, so no frame goes
+    through python.
+    """
+
+    def __init__(
+        self,
+        video_paths: list[str],
+        frame_pts: list[np.ndarray],
+        crop_rects: list[tuple[int, int]],
+        out_width: int,
+        out_height: int,
+        fps: float,
+        encode_parameters: list[str],
+        threads: int = 0,
+    ) -> None:
+        self.video_paths = video_paths
+        # frame presentation times of each video relative to its first frame
+        self.frame_pts = frame_pts
+        # (width, height) of the top left crop applied to each video
+        self.crop_rects = crop_rects
+        self.out_width = out_width
+        self.out_height = out_height
+        self.fps = fps
+        self.encode_parameters = encode_parameters
+        self.threads = threads
+
+    def command(
+        self,
+        segments: list[tuple[int, int, int, int]],
+        audio_path: str,
+        o_path: str,
+    ) -> list[str]:
+        """
+        segments are (video index, first frame in the video, first output frame, number of
+        output frames). Every video is an input seeked to its first segment and split into
+        the segments of the video, so the number of inputs doesn't grow with the number of
+        segments. Videos with a variable frame rate are resampled by the fps filter.
+        """
+        video_idxs = sorted({segment[0] for segment in segments})
+        inputs = []
+        filters = []
+        input_starts = {}
+        splits = {}
+        for input_idx, video_idx in enumerate(video_idxs):
+            video_segments = [segment for segment in segments if segment[0] == video_idx]
+            input_starts[video_idx] = FrameTimes.seek_time(
+                self.frame_pts[video_idx], min(segment[1] for segment in video_segments)
+            )
+            inputs += [
+                "-ss",
+                "{:.6f}".format(input_starts[video_idx]),
+                "-threads",
+                str(self.threads),
+                "-i",
+                self.video_paths[video_idx],
+            ]
+            splits[video_idx] = [f"s{input_idx}_{idx}" for idx in range(len(video_segments))]
+            labels = "".join(f"[{label}]" for label in splits[video_idx])
+            filters.append(f"[{input_idx}:v]split={len(video_segments)}{labels}")
+        for idx, (video_idx, start_frame, _, n_frames) in enumerate(segments):
+            # the input timestamps start at 0 where it was seeked
+            start = (
+                FrameTimes.seek_time(self.frame_pts[video_idx], start_frame)
+                - input_starts[video_idx]
+            )
+            crop_width, crop_height = self.crop_rects[video_idx]
+            filters.append(
+                f"[{splits[video_idx].pop(0)}]trim=start={start:.6f},setpts=PTS-STARTPTS,"
+                f"fps={self.fps},trim=end_frame={n_frames},"
+                f"crop={crop_width}:{crop_height}:0:0,"
+                f"scale={self.out_width}:{self.out_height},setsar=1[v{idx}]"
+            )
+        labels = "".join(f"[v{idx}]" for idx in range(len(segments)))
+        filters.append(f"{labels}concat=n={len(segments)}:v=1:a=0[outv]")
+        return [
+            "ffmpeg",
+            "-loglevel",
+            "error",
+            "-filter_threads",
+            str(self.threads),
+            *inputs,
+            "-i",
+            audio_path,
+            "-filter_complex",
+            ";".join(filters),
+            "-map",
+            "[outv]",
+            "-map",
+            f"{len(video_idxs)}:a",
+            *self.encode_parameters,
+            "-pix_fmt",
+            "yuv420p",
+            "-threads",
+            str(self.threads),
+            *OUT_AUDIO_PARAMETERS,
+            "-shortest",
+            o_path,
+            "-y",
+        ]
+
+    def render(
+        self,
+        segments: list[tuple[int, int, int, int]],
+        audio_path: str,
+        o_path: str,
+    ) -> None:
+        info(f"Rendering {len(segments)} segments with a filtergraph into {o_path}...")
+        result = JobScheduler().run_job(self.command(segments, audio_path, o_path))
+        if result.return_code != 0:
+            raise CalledProcessError(result.return_code, result.argv, stderr=result.stderr)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,118 @@
+from typing import NamedTuple
+
+import numpy as np
+from constants import (
+    NORM_SR,
+    SYNC_CANDIDATE_DISTANCE,
+    SYNC_CANDIDATES,
+    SYNC_FINGERPRINT_RATE,
+    SYNC_FINGERPRINT_WINDOW,
+)
+from librosa.onset import onset_strength
+from scipy.signal import fftconvolve, find_peaks
+from Synchronizer import Synchronizer
+
+
+class Fingerprint(NamedTuple):
+    # onset strength of every frame, normalized to zero mean and unit variance
+    onsets: np.ndarray
+    # samples of the audio it was computed from
+    n_samples: int
+
+
+class FingerprintSynchronizer:
+    """
+    Synchronize onset strength envelopes at SYNC_FINGERPRINT_RATE instead of waveforms. Onsets
+    survive the crowd noise and room sound of camera microphones better, and the fingerprints
+    are small enough to cache and compare against long references in milliseconds.
+    When a waveform synchronizer of the reference is given, offsets are refined with it
+    within a couple of frames.
+    """
+
+    def __init__(
+        self,
+        reference_fingerprint: Fingerprint,
+        sample_rate: int = int(NORM_SR),
+        refine_synchronizer: Synchronizer = None,
+    ) -> None:
+        self.reference_fingerprint = reference_fingerprint
+        self.sample_rate = sample_rate
+        self.hop_length = sample_rate // SYNC_FINGERPRINT_RATE
+        self.refine_synchronizer = refine_synchronizer
+
+    @staticmethod
+    def fingerprint(
+        audio: np.ndarray,
+        sample_rate: int = int(NORM_SR),
+    ) -> Fingerprint:
+        onsets = onset_strength(
+            y=audio,
+            sr=sample_rate,
+            hop_length=sample_rate // SYNC_FINGERPRINT_RATE,
+            n_fft=SYNC_FINGERPRINT_WINDOW,
+        ).astype(np.float32)
+        onsets -= onsets.mean()
+        onsets /= max(onsets.std(), np.finfo(np.float32).eps)
+        return Fingerprint(onsets, len(audio))
+
+    @staticmethod
+    def subframe(
+        correlation: np.ndarray,
+        peak: int,
+    ) -> float:
+        # vertex of the parabola through the peak and its neighbours
+        if peak == 0 or peak == len(correlation) - 1:
+            return 0.0
+        left, center, right = correlation[peak - 1 : peak + 2]
+        curvature = left - 2 * center + right
+        return float(0.5 * (left - right) / curvature) if curvature < 0 else 0.0
+
+    def find_offset(
+        self,
+        target_fingerprint: Fingerprint,
+        target_audio: np.ndarray = None,
+    ) -> tuple[int, float]:
+        """
+        Return the offset in samples maximizing the onsets correlation and how many robust
+        standard deviations its peak is above the median correlation. The ratio to the next
+        best peak the waveform search uses stays close to 1 on rhythmic music, where every
+        bar correlates almost as well as the right one, even for right matches.
+        """
+        reference_onsets = self.reference_fingerprint.onsets
+        correlation = fftconvolve(
+            target_fingerprint.onsets, reference_onsets[::-1], mode="full"
+        )
+        distance = max(1, int(SYNC_CANDIDATE_DISTANCE * SYNC_FINGERPRINT_RATE))
+        peaks, _ = find_peaks(correlation, distance=distance)
+        if len(peaks) == 0:
+            peaks = np.array([np.argmax(correlation)])
+        peaks = peaks[np.argsort(correlation[peaks])[::-1][:SYNC_CANDIDATES]]
+        median = np.median(correlation)
+        # median absolute deviation scaled to the standard deviation of a normal distribution
+        deviation = 1.4826 * np.median(np.abs(correlation - median))
+        peak = correlation[peaks[0]] - median
+        confidence = float(peak / deviation) if deviation > 0 else float("inf")
+        offset = round(
+            (peaks[0] + self.subframe(correlation, peaks[0]) - (len(reference_onsets) - 1))
+            * self.hop_length
+        )
+        if self.refine_synchronizer is not None and target_audio is not None:
+            offset = self.refine_synchronizer.refine_offset(
+                target_audio, offset, 2 * self.hop_length
+            )
+        return offset, confidence
+
+    def offsets(
+        self,
+        target_fingerprint: Fingerprint,
+        target_audio: np.ndarray = None,
+    ) -> tuple[int, int, float]:
+        start_offset, confidence = self.find_offset(target_fingerprint, target_audio)
+        end_offset = self.reference_fingerprint.n_samples - (
+            target_fingerprint.n_samples + start_offset
+        )
+        return start_offset, end_offset, confidence
+
+
+if __name__ == "__main__":
+    pass
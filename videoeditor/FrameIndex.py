@@ -0,0 +1,114 @@
+from hashlib import sha1
+from os import getpid, makedirs, replace
+from os.path import exists, join
+from subprocess import check_output
+from threading import get_ident
+from typing import NamedTuple
+
+import numpy as np
+from JsonCache import JsonCache
+
+
+class FrameTimes(NamedTuple):
+    # presentation time in seconds of every video frame, sorted
+    pts: np.ndarray
+    # presentation time in seconds of every keyframe, sorted
+    keyframes: np.ndarray
+
+    def relative(
+        self,
+    ) -> "FrameTimes":
+        # times from the first frame, ffmpeg adds the start time of the file to -ss
+        first = self.pts[0] if len(self.pts) else 0.0
+        return FrameTimes(self.pts - first, self.keyframes - first)
+
+    @staticmethod
+    def seek_time(
+        pts: np.ndarray,
+        frame_idx: int,
+    ) -> float:
+        """
+        Time to seek for the decoder to start at frame_idx: halfway from the previous frame,
+        so the rounding of the seek can't skip the frame or keep the previous one
+        """
+        if frame_idx == 0:
+            return float(pts[0])
+        return float(pts[frame_idx - 1] + pts[frame_idx]) / 2
+
+
+class FrameIndex:
+    """
+    Per-file index of the video packets timestamps and keyframes, built once with ffprobe
+    and kept in a cache folder as .npz files named after the file key.
+    """
+
+    FFPROBE_COMMAND = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "packet=pts_time,flags",
+        "-of",
+        "csv=p=0",
+    ]
+
+    def __init__(
+        self,
+        cache_folder: str,
+    ) -> None:
+        self.cache_folder = cache_folder
+        makedirs(self.cache_folder, exist_ok=True)
+
+    def _cache_path(
+        self,
+        path: str,
+    ) -> str:
+        return join(
+            self.cache_folder, sha1(JsonCache.file_key(path).encode()).hexdigest() + ".npz"
+        )
+
+    def _run_ffprobe(
+        self,
+        path: str,
+    ) -> FrameTimes:
+        output = check_output(
+            [*self.FFPROBE_COMMAND, path],
+            text=True,
+        )
+        pts = []
+        keyframes = []
+        for line in output.splitlines():
+            pts_time, _, flags = line.partition(",")
+            if pts_time in ("", "N/A"):
+                continue
+            pts.append(float(pts_time))
+            if "K" in flags:
+                keyframes.append(float(pts_time))
+        # packets come in decode order
+        return FrameTimes(np.sort(pts), np.sort(keyframes))
+
+    def get(
+        self,
+        path: str,
+        cache: bool = True,
+    ) -> FrameTimes:
+        """
+        Return the frame times of path. Temporary files are indexed with cache=False.
+        """
+        if not cache:
+            return self._run_ffprobe(path)
+        cache_path = self._cache_path(path)
+        if exists(cache_path):
+            with np.load(cache_path) as cached:
+                return FrameTimes(cached["pts"], cached["keyframes"])
+        frame_times = self._run_ffprobe(path)
+        tmp_path = f"{cache_path}.{getpid()}.{get_ident()}.tmp.npz"
+        np.savez(tmp_path, **frame_times._asdict())
+        replace(tmp_path, cache_path)
+        return frame_times
+
+
+if __name__ == "__main__":
+    pass
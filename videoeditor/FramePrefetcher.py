@@ -0,0 +1,77 @@
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+
+from constants import RENDER_QUEUE_FRAMES
+
+
+class FramePrefetcher:
+    """
+    Run a frame generator in a background thread, ahead of the consumer by up to max_frames
+    frames. Decoding the next frames, and opening and seeking the video of the next segment,
+    overlaps with encoding the current ones.
+    """
+
+    _END = object()
+
+    def __init__(
+        self,
+        frames,
+        max_frames: int = RENDER_QUEUE_FRAMES,
+    ) -> None:
+        self.frames = frames
+        self.queue = Queue(maxsize=max(1, max_frames))
+        self.stopped = Event()
+        self.exception = None
+        self.thread = Thread(target=self._produce, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stopped.set()
+        # unblock the producer if the queue is full
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Empty:
+                pass
+        self.thread.join()
+
+    def _put(
+        self,
+        item,
+    ) -> bool:
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _produce(
+        self,
+    ) -> None:
+        try:
+            for frame in self.frames:
+                if not self._put(frame):
+                    break
+        except BaseException as e:
+            self.exception = e
+        finally:
+            self.frames.close()
+            self._put(self._END)
+
+    def __iter__(self):
+        while True:
+            frame = self.queue.get()
+            if frame is self._END:
+                break
+            yield frame
+        if self.exception is not None:
+            raise self.exception
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,96 @@
+from contextlib import contextmanager
+from os.path import abspath, dirname, exists, getsize, ismount
+from threading import Lock
+from time import perf_counter
+
+
+class IOStats:
+    """
+    Bytes read and written by every stage of a run, split by the mount point of the files.
+    Sizes come from the files, an input given as (path, fraction) counts that fraction of its
+    size, as the seconds read of a seeked or partly decoded file at its mean bitrate.
+    """
+
+    def __init__(
+        self,
+    ) -> None:
+        self.stages = {}
+        self.lock = Lock()
+
+    @staticmethod
+    def mount_point(
+        path: str,
+    ) -> str:
+        path = abspath(path)
+        while not ismount(path):
+            path = dirname(path)
+        return path
+
+    def _add_bytes(
+        self,
+        counts: dict,
+        paths: list,
+    ) -> None:
+        for path in paths:
+            path, fraction = (path, 1.0) if isinstance(path, str) else path
+            if exists(path):
+                mount_point = self.mount_point(path)
+                n_bytes = round(getsize(path) * min(1.0, max(0.0, fraction)))
+                counts[mount_point] = counts.get(mount_point, 0) + n_bytes
+
+    def record(
+        self,
+        stage: str,
+        read_paths: list | None = None,
+        written_paths: list[str] | None = None,
+        elapsed: float = 0.0,
+    ) -> None:
+        with self.lock:
+            stats = self.stages.setdefault(
+                stage, {"calls": 0, "elapsed": 0.0, "read": {}, "written": {}}
+            )
+            stats["calls"] += 1
+            stats["elapsed"] += elapsed
+            self._add_bytes(stats["read"], read_paths or [])
+            self._add_bytes(stats["written"], written_paths or [])
+
+    @contextmanager
+    def measure(
+        self,
+        stage: str,
+        read_paths: list | None = None,
+        written_paths: list[str] | None = None,
+    ):
+        """
+        Record the paths once the stage is done, when the written files have their size.
+        Inputs whose read fraction is only known at the end are appended to the yielded list.
+        """
+        start_time = perf_counter()
+        read_paths = list(read_paths or [])
+        try:
+            yield read_paths
+        finally:
+            self.record(stage, read_paths, written_paths, perf_counter() - start_time)
+
+    def report(
+        self,
+    ) -> str:
+        lines = ["I/O per stage:"]
+        for stage, stats in self.stages.items():
+            lines.append(
+                f"  {stage}: {stats['calls']} calls in {stats['elapsed']:.1f}s, "
+                f"read {self._format(stats['read'])}, wrote {self._format(stats['written'])}"
+            )
+        return "\n".join(lines)
+
+    @staticmethod
+    def _format(
+        counts: dict,
+    ) -> str:
+        if not counts:
+            return "0 MB"
+        return ", ".join(f"{n / 1024**2:.1f} MB on {path}" for path, n in counts.items())
+
+
+if __name__ == "__main__":
+    pass
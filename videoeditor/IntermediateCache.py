@@ -0,0 +1,179 @@
+from fcntl import LOCK_EX, flock
+from hashlib import sha256
+from json import dump, dumps, load
+from logging import debug, info
+from os import getpid, listdir, makedirs, remove, replace, stat, unlink, utime
+from os.path import join
+from shutil import copyfile
+from threading import get_ident
+
+import numpy as np
+from constants import CACHE_FOLDER, CACHE_MAX_BYTES
+from ContentHashes import ContentHashes
+
+
+class IntermediateCache:
+    """
+    Content addressed store for intermediate files, arrays and json results shared by all
+    runs. Keys hash the content of the inputs and the exact parameters used to produce an
+    entry. When the cache grows over max_bytes the least recently used entries are evicted.
+    """
+
+    def __init__(
+        self,
+        cache_folder: str = CACHE_FOLDER,
+        max_bytes: int = CACHE_MAX_BYTES,
+    ) -> None:
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        self.entries_folder = join(cache_folder, "entries")
+        makedirs(self.entries_folder, exist_ok=True)
+        self.content_hashes = ContentHashes(join(cache_folder, "content_hashes.json"))
+
+    @staticmethod
+    def key(
+        *parts,
+    ) -> str:
+        return sha256(dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def _entry_path(
+        self,
+        key: str,
+        extension: str = "",
+    ) -> str:
+        return join(self.entries_folder, key + extension)
+
+    def _tmp_path(
+        self,
+        entry_path: str,
+    ) -> str:
+        return f"{entry_path}.{getpid()}.{get_ident()}.tmp"
+
+    @staticmethod
+    def _copy(
+        src: str,
+        dst: str,
+    ) -> None:
+        # entries never share the inode of a file outside the cache, ffmpeg -y truncates the
+        # file it writes in place and would change the entry with it
+        try:
+            unlink(dst)
+        except FileNotFoundError:
+            pass
+        copyfile(src, dst)
+
+    def _touch(
+        self,
+        entry_path: str,
+    ) -> bool:
+        # mtime is the last use of an entry, the eviction order
+        try:
+            utime(entry_path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def get_file(
+        self,
+        key: str,
+        o_path: str,
+    ) -> bool:
+        entry_path = self._entry_path(key)
+        if not self._touch(entry_path):
+            return False
+        try:
+            self._copy(entry_path, o_path)
+        except FileNotFoundError:
+            # evicted by another run in the meantime
+            return False
+        debug(f"Cache hit {key} -> {o_path}")
+        return True
+
+    def put_file(
+        self,
+        key: str,
+        i_path: str,
+    ) -> None:
+        entry_path = self._entry_path(key)
+        tmp_path = self._tmp_path(entry_path)
+        self._copy(i_path, tmp_path)
+        replace(tmp_path, entry_path)
+
+    def get_array(
+        self,
+        key: str,
+    ) -> np.ndarray:
+        entry_path = self._entry_path(key, ".npy")
+        if not self._touch(entry_path):
+            return None
+        try:
+            return np.load(entry_path)
+        except FileNotFoundError:
+            return None
+
+    def put_array(
+        self,
+        key: str,
+        array: np.ndarray,
+    ) -> None:
+        entry_path = self._entry_path(key, ".npy")
+        tmp_path = self._tmp_path(entry_path)
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        replace(tmp_path, entry_path)
+
+    def get_json(
+        self,
+        key: str,
+    ):
+        entry_path = self._entry_path(key, ".json")
+        if not self._touch(entry_path):
+            return None
+        try:
+            with open(entry_path) as f:
+                return load(f)
+        except FileNotFoundError:
+            return None
+
+    def put_json(
+        self,
+        key: str,
+        value,
+    ) -> None:
+        entry_path = self._entry_path(key, ".json")
+        tmp_path = self._tmp_path(entry_path)
+        with open(tmp_path, "w") as f:
+            dump(value, f)
+        replace(tmp_path, entry_path)
+
+    def evict(
+        self,
+    ) -> None:
+        """
+        Remove least recently used entries until the cache fits in max_bytes
+        """
+        with open(join(self.cache_folder, ".lock"), "w") as lock:
+            flock(lock, LOCK_EX)
+            entries = []
+            for filename in listdir(self.entries_folder):
+                if filename.endswith(".tmp"):
+                    continue
+                try:
+                    stats = stat(join(self.entries_folder, filename))
+                except FileNotFoundError:
+                    continue
+                entries.append((stats.st_mtime, stats.st_size, filename))
+            total_bytes = sum(size for _, size, _ in entries)
+            for _, size, filename in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+                try:
+                    remove(join(self.entries_folder, filename))
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
+                info(f"Evicted {filename} from the cache")
+
+
+if __name__ == "__main__":
+    pass
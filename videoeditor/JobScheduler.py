@@ -0,0 +1,145 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from logging import debug
+from subprocess import PIPE, run
+from threading import BoundedSemaphore
+from time import perf_counter
+from typing import NamedTuple
+
+from constants import CPU_BUDGET, FFMPEG_THREADS
+
+
+class JobResult(NamedTuple):
+    argv: list[str]
+    return_code: int
+    stderr: str
+    elapsed: float
+
+
+class JobScheduler:
+    """
+    Run argv jobs in-process, keeping the number of running jobs times the threads
+    each job spawns within the cpu budget.
+    """
+
+    def __init__(
+        self,
+        cpu_budget: int = CPU_BUDGET,
+        threads_per_job: int = FFMPEG_THREADS,
+    ) -> None:
+        self.cpu_budget = max(1, cpu_budget)
+        self.threads_per_job = max(1, threads_per_job)
+        # jobs started from several threads at once still share the budget
+        self.slots = BoundedSemaphore(self.max_workers(self.cpu_budget))
+
+    def max_workers(
+        self,
+        n_jobs: int,
+    ) -> int:
+        return max(1, min(n_jobs, self.cpu_budget // self.threads_per_job))
+
+    def run_job(
+        self,
+        argv: list[str],
+    ) -> JobResult:
+        with self.slots:
+            debug(" ".join(argv))
+            start = perf_counter()
+            process = run(
+                argv,
+                stdout=PIPE,
+                stderr=PIPE,
+                text=True,
+            )
+        return JobResult(
+            argv,
+            process.returncode,
+            process.stderr,
+            perf_counter() - start,
+        )
+
+    def run_chain(
+        self,
+        argvs: list[list[str]],
+    ) -> JobResult:
+        """
+        Run dependent commands one after the other, stopping at the first failure
+        """
+        elapsed = 0.0
+        for argv in argvs:
+            result = self.run_job(argv)
+            elapsed += result.elapsed
+            if result.return_code != 0:
+                break
+        return result._replace(elapsed=elapsed)
+
+    def _run(
+        self,
+        job: list,
+    ) -> JobResult:
+        return self.run_chain(job) if isinstance(job[0], list) else self.run_job(job)
+
+    def run(
+        self,
+        jobs: list[list],
+        n_processes: int = None,
+    ) -> list[JobResult]:
+        """
+        Run all jobs and return their results in submission order. A job is an argv list or
+        a list of argv lists run as a chain. n_processes optionally lowers the concurrency
+        allowed by the cpu budget.
+        """
+        if not jobs:
+            return []
+        n_workers = self.max_workers(len(jobs) if n_processes is None else n_processes)
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            return list(executor.map(self._run, jobs))
+
+
+class TaskGraph:
+    """
+    Run python callables as soon as the tasks they depend on are done. Each callable gets the
+    results of its dependencies as arguments, in the order they were given.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = CPU_BUDGET,
+    ) -> None:
+        self.max_workers = max(1, max_workers)
+        self.tasks = {}
+
+    def add(
+        self,
+        name: str,
+        function,
+        dependencies: list[str] = [],
+    ) -> None:
+        missing = [d for d in dependencies if d not in self.tasks]
+        if missing:
+            raise ValueError(f"Task {name} depends on unknown tasks {missing}")
+        self.tasks[name] = (function, dependencies)
+
+    def run(
+        self,
+    ) -> dict:
+        """
+        Return the result of every task by name, the first failing task raises its exception
+        """
+        results = {}
+        pending = dict(self.tasks)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for name, (function, dependencies) in list(pending.items()):
+                    if all(d in results for d in dependencies):
+                        future = executor.submit(function, *[results[d] for d in dependencies])
+                        running[future] = name
+                        del pending[name]
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+        return results
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,72 @@
+from fcntl import LOCK_EX, flock
+from json import JSONDecodeError, dump, load
+from os import getpid, replace, stat
+from os.path import abspath, exists
+
+
+class JsonCache:
+    """
+    Small persistent key/value store kept in a json file. Writes merge with what is on disk
+    under a file lock, so several editors can share the same cache file.
+    """
+
+    def __init__(
+        self,
+        path: str,
+    ) -> None:
+        self.path = path
+        self.entries = self._read()
+        self.pending = {}
+
+    @staticmethod
+    def file_key(
+        path: str,
+    ) -> str:
+        # a file is considered unchanged while its path, size and mtime are the same
+        stats = stat(path)
+        return f"{abspath(path)}|{stats.st_size}|{stats.st_mtime_ns}"
+
+    def _read(
+        self,
+    ) -> dict:
+        if not exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return load(f)
+        except (JSONDecodeError, OSError):
+            return {}
+
+    def get(
+        self,
+        key: str,
+    ):
+        return self.entries.get(key)
+
+    def set(
+        self,
+        key: str,
+        value,
+    ) -> None:
+        self.entries[key] = value
+        self.pending[key] = value
+
+    def save(
+        self,
+    ) -> None:
+        if not self.pending:
+            return
+        with open(self.path + ".lock", "w") as lock:
+            flock(lock, LOCK_EX)
+            entries = self._read()
+            entries.update(self.pending)
+            tmp_path = f"{self.path}.{getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                dump(entries, f)
+            replace(tmp_path, self.path)
+        self.entries = entries
+        self.pending = {}
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,106 @@
+from concurrent.futures import ThreadPoolExecutor
+from json import loads
+from logging import info
+from subprocess import check_output
+from typing import NamedTuple
+
+from constants import CPU_BUDGET
+from JsonCache import JsonCache
+
+
+class MediaInfo(NamedTuple):
+    width: int
+    height: int
+    frame_rate: float
+    n_frames: int
+    video_codec: str
+    duration: float
+    sample_rate: int
+    channels: int
+
+
+class MediaProbe:
+    FFPROBE_COMMAND = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-print_format",
+        "json",
+        "-show_format",
+        "-show_streams",
+    ]
+
+    def __init__(
+        self,
+        cache_path: str,
+    ) -> None:
+        self.cache = JsonCache(cache_path)
+
+    @staticmethod
+    def _parse_rate(
+        rate: str,
+    ) -> float:
+        num, _, den = rate.partition("/")
+        if float(den or 1) == 0.0:
+            return 0.0
+        return float(num) / float(den or 1)
+
+    def _run_ffprobe(
+        self,
+        path: str,
+    ) -> dict:
+        output = check_output(
+            [*self.FFPROBE_COMMAND, path],
+            text=True,
+        )
+        probe = loads(output)
+        streams = probe.get("streams", [])
+        video = next((s for s in streams if s["codec_type"] == "video"), {})
+        audio = next((s for s in streams if s["codec_type"] == "audio"), {})
+
+        duration = float(probe.get("format", {}).get("duration") or audio.get("duration") or 0)
+        frame_rate = self._parse_rate(video.get("avg_frame_rate", "0/0")) or self._parse_rate(
+            video.get("r_frame_rate", "0/0")
+        )
+        n_frames = int(video.get("nb_frames") or round(duration * frame_rate))
+        width = int(video.get("width", 0))
+        height = int(video.get("height", 0))
+        # phone footage is stored landscape with a rotation, ffmpeg and opencv output it rotated
+        rotation = int(video.get("tags", {}).get("rotate", 0))
+        for side_data in video.get("side_data_list", []):
+            rotation = int(side_data.get("rotation", rotation))
+        if rotation % 180:
+            width, height = height, width
+        return MediaInfo(
+            width,
+            height,
+            frame_rate,
+            n_frames,
+            video.get("codec_name", ""),
+            duration,
+            int(audio.get("sample_rate", 0)),
+            int(audio.get("channels", 0)),
+        )._asdict()
+
+    def probe_all(
+        self,
+        paths: list[str],
+    ) -> list[MediaInfo]:
+        """
+        Return the media info of every path, running ffprobe concurrently for the files
+        not found in the cache.
+        """
+        keys = [JsonCache.file_key(p) for p in paths]
+        missing = [(k, p) for k, p in zip(keys, paths) if self.cache.get(k) is None]
+        if missing:
+            info(f"Probing {len(missing)} mediafiles...")
+            with ThreadPoolExecutor(max_workers=min(len(missing), CPU_BUDGET)) as executor:
+                probed = executor.map(self._run_ffprobe, [p for _, p in missing])
+                for (key, _), media_info in zip(missing, probed):
+                    self.cache.set(key, media_info)
+            self.cache.save()
+        return [MediaInfo(**self.cache.get(k)) for k in keys]
+
+
+if __name__ == "__main__":
+    pass
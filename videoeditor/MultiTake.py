@@ -1,43 +1,71 @@
-from constants import NORM_FPS
-from cv2 import CAP_PROP_FPS, CAP_PROP_FRAME_HEIGHT, CAP_PROP_FRAME_WIDTH, VideoCapture
-from librosa import beat, load
+import numpy as np
+from constants import BEAT_HOP_LENGTH, NORM_FPS, NORM_SR
+from DecoderPool import DecoderPool
+from librosa import beat, onset
 
 
 class MultiTake:
-    def __init__(self, audio_path, video_paths):
+    def __init__(
+        self, audio_path, video_paths, video_metadata, frame_times, time_offsets, beat_times
+    ):
         self.audio_path = audio_path
         self.video_paths = video_paths
+        # (width, height, frame_rate) of each video, as probed by the FileManager
+        self.video_metadata = video_metadata
+        # frame presentation times of each video, relative to its first frame
+        self.frame_pts = [f.relative().pts for f in frame_times]
+        self.keyframe_idxs = [np.searchsorted(f.pts, f.keyframes) for f in frame_times]
+        # seconds to add to a reference audio second to get the second of each video
+        self.time_offsets = time_offsets
 
-        self.audio_clip, self.sample_rate = load(
-            self.audio_path,
-            dtype="float64",
+        # beats of the reference audio within the cut, in seconds from its start
+        self.audio_beats = [int(b * float(NORM_FPS)) for b in beat_times]
+
+    @staticmethod
+    def analyze_beats(audio, sample_rate=int(NORM_SR)):
+        """
+        Tempo, beat and onset times in seconds of a whole audio, the onset strength envelope
+        is computed once for both
+        """
+        onset_envelope = onset.onset_strength(
+            y=audio,
+            sr=sample_rate,
+            hop_length=BEAT_HOP_LENGTH,
+        )
+        tempo, beats = beat.beat_track(
+            onset_envelope=onset_envelope,
+            sr=sample_rate,
+            hop_length=BEAT_HOP_LENGTH,
+            units="time",
         )
-        self.audio_tempo, self.audio_beats = beat.beat_track(
-            y=self.audio_clip,
-            sr=self.sample_rate,
+        onsets = onset.onset_detect(
+            onset_envelope=onset_envelope,
+            sr=sample_rate,
+            hop_length=BEAT_HOP_LENGTH,
             units="time",
         )
-        self.audio_beats = [int(b * float(NORM_FPS)) for b in self.audio_beats]
-        self.video_metadata = []
-        for v_path in video_paths:
-            cap = VideoCapture(v_path)
-            # get info from current video in use
-            frame_rate = int(cap.get(CAP_PROP_FPS))
-            frame_width = int(cap.get(CAP_PROP_FRAME_WIDTH))
-            frame_height = int(cap.get(CAP_PROP_FRAME_HEIGHT))
-            self.video_metadata.append(
-                (
-                    frame_width,
-                    frame_height,
-                    frame_rate,
-                )
-            )
-
-    def get_video_clip(self, video_idx):
-        return VideoCapture(self.video_paths[video_idx])
-
-    def get_video_metadata(self, video_idx):
-        return self.video_metadata[video_idx]
+        return {
+            "tempo": float(np.atleast_1d(tempo)[0]),
+            "beats": [float(b) for b in beats],
+            "onsets": [float(o) for o in onsets],
+        }
+
+    def get_decoder_pool(self, crop_rects, out_size):
+        # readers of the videos giving frames cropped to crop_rects and scaled to out_size
+        return DecoderPool(
+            self.video_paths, self.frame_pts, self.keyframe_idxs, crop_rects, out_size
+        )
+
+    def get_source_frames(self, video_idx, reference_times):
+        """
+        Index of the frame of the video shown at each second of the reference audio,
+        frames are repeated or skipped when the video frame rate differs from the output
+        """
+        pts = self.frame_pts[video_idx]
+        video_times = np.asarray(reference_times) + self.time_offsets[video_idx]
+        # the frame shown at a time is the last one presented before it
+        frame_idxs = np.searchsorted(pts, video_times + 1e-6, side="right") - 1
+        return np.clip(frame_idxs, 0, len(pts) - 1)
 
 
 if __name__ == "__main__":
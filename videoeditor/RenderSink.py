@@ -0,0 +1,117 @@
+from logging import info
+from os import remove
+from os.path import exists
+from subprocess import PIPE, CalledProcessError, Popen
+from tempfile import TemporaryFile
+
+import numpy as np
+from constants import OUT_AUDIO_PARAMETERS
+
+
+class RenderSink:
+    """
+    Encode the BGR frames written from python with a single ffmpeg process, muxing the audio
+    in the same pass unless audio_path is None. Writes block while ffmpeg is behind, so memory
+    use stays bounded.
+    """
+
+    def __init__(
+        self,
+        o_path: str,
+        width: int,
+        height: int,
+        fps: float,
+        audio_path: str,
+        encode_parameters: list[str],
+        threads: int = 0,
+    ) -> None:
+        self.o_path = o_path
+        self.argv = [
+            "ffmpeg",
+            "-loglevel",
+            "error",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "bgr24",
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            str(fps),
+            "-i",
+            "pipe:0",
+        ]
+        if audio_path is not None:
+            self.argv += ["-i", audio_path, "-map", "0:v", "-map", "1:a"]
+        self.argv += [
+            *encode_parameters,
+            "-pix_fmt",
+            "yuv420p",
+            "-threads",
+            str(threads),
+        ]
+        if audio_path is not None:
+            self.argv += [*OUT_AUDIO_PARAMETERS, "-shortest"]
+        self.argv += [o_path, "-y"]
+        self.process = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def open(
+        self,
+    ) -> None:
+        # stderr goes to a file so a chatty ffmpeg can't fill a pipe nobody is reading
+        self.stderr = TemporaryFile()
+        self.process = Popen(self.argv, stdin=PIPE, stderr=self.stderr)
+        info(f"Rendering {self.o_path}...")
+
+    def write(
+        self,
+        frame: np.ndarray,
+    ) -> None:
+        try:
+            self.process.stdin.write(np.ascontiguousarray(frame).data)
+        except BrokenPipeError:
+            # ffmpeg exited, report why
+            self.process.wait()
+            raise self._error()
+
+    def _error(
+        self,
+    ) -> CalledProcessError:
+        self.stderr.seek(0)
+        return CalledProcessError(
+            self.process.returncode, self.argv, stderr=self.stderr.read().decode()
+        )
+
+    def close(
+        self,
+    ) -> None:
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        if self.process.wait() != 0:
+            raise self._error()
+        self.stderr.close()
+
+    def abort(
+        self,
+    ) -> None:
+        self.process.kill()
+        self.process.wait()
+        self.stderr.close()
+        if exists(self.o_path):
+            remove(self.o_path)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,78 @@
+from logging import debug, info
+from os import W_OK, access, makedirs
+from os.path import isdir, join
+from shutil import disk_usage, rmtree
+from tempfile import mkdtemp
+from threading import Lock
+
+from constants import SCRATCH_RESERVE_BYTES, SCRATCH_TIERS
+
+
+class ScratchStorage:
+    """
+    Temporary folders for the intermediate files of a run. Each kind of file goes to the
+    first of its tiers with enough free space left, the fallback folder is used when every
+    tier is full or missing.
+    """
+
+    def __init__(
+        self,
+        fallback_folder: str,
+        tiers: dict[str, list[str]] = SCRATCH_TIERS,
+        reserve_bytes: int = SCRATCH_RESERVE_BYTES,
+    ) -> None:
+        self.fallback_folder = fallback_folder
+        self.tiers = {kind: [*roots, fallback_folder] for kind, roots in tiers.items()}
+        self.reserve_bytes = reserve_bytes
+        # temporary folder of this run in every tier used, created on first use
+        self.folders = {}
+        # bytes promised to the files allocated in each tier that may not be written yet
+        self.allocated = {}
+        self.lock = Lock()
+
+    def _has_room(
+        self,
+        root: str,
+        n_bytes: int,
+    ) -> bool:
+        if not isdir(root) or not access(root, W_OK):
+            return False
+        free = disk_usage(root).free - self.allocated.get(root, 0)
+        return free >= n_bytes + self.reserve_bytes
+
+    def folder(
+        self,
+        kind: str,
+        subfolder: str,
+        n_bytes: int = 0,
+    ) -> str:
+        """
+        Return a folder to write about n_bytes of intermediate files of the given kind
+        """
+        with self.lock:
+            for root in self.tiers[kind]:
+                if root == self.fallback_folder or self._has_room(root, n_bytes):
+                    break
+                debug(f"Scratch {root} has no room for {n_bytes} bytes of {kind}")
+            if root not in self.folders:
+                self.folders[root] = mkdtemp(prefix="videoeditor_", dir=root)
+            self.allocated[root] = self.allocated.get(root, 0) + n_bytes
+            path = join(self.folders[root], subfolder)
+            makedirs(path, exist_ok=True)
+            return path
+
+    def cleanup(
+        self,
+    ) -> None:
+        for folder in self.folders.values():
+            try:
+                rmtree(folder)
+                info(f"Folder '{folder}' and its contents have been removed.")
+            except Exception as e:
+                info(f"An error occurred: {e}")
+        self.folders = {}
+        self.allocated = {}
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,78 @@
+from ContentHashes import ContentHashes
+from JsonCache import JsonCache
+
+
+class SyncIndex:
+    """
+    Offsets and match confidence of the videos of a project, kept in a json file in the
+    project folder. Entries are keyed by the content hashes of the reference audio and of the
+    video and by the sync method, so only new or edited videos are synchronized again.
+    The analysis of the reference audio is kept along, keyed by its content hash.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        content_hashes: ContentHashes,
+    ) -> None:
+        self.entries = JsonCache(path)
+        self.content_hashes = content_hashes
+
+    def _key(
+        self,
+        reference_path: str,
+        video_path: str,
+        method: str,
+    ) -> str:
+        return "|".join(
+            [
+                "offsets",
+                self.content_hashes.get(reference_path),
+                self.content_hashes.get(video_path),
+                method,
+            ]
+        )
+
+    def get(
+        self,
+        reference_path: str,
+        video_path: str,
+        method: str,
+    ) -> list:
+        """
+        Return [start offset, end offset, confidence] or None when the video isn't indexed
+        """
+        return self.entries.get(self._key(reference_path, video_path, method))
+
+    def set(
+        self,
+        reference_path: str,
+        video_path: str,
+        method: str,
+        offsets: list,
+    ) -> None:
+        self.entries.set(self._key(reference_path, video_path, method), offsets)
+
+    def get_analysis(
+        self,
+        audio_path: str,
+        name: str,
+    ) -> dict:
+        return self.entries.get("|".join([name, self.content_hashes.get(audio_path)]))
+
+    def set_analysis(
+        self,
+        audio_path: str,
+        name: str,
+        analysis: dict,
+    ) -> None:
+        self.entries.set("|".join([name, self.content_hashes.get(audio_path)]), analysis)
+
+    def save(
+        self,
+    ) -> None:
+        self.entries.save()
+
+
+if __name__ == "__main__":
+    pass
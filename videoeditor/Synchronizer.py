@@ -1,25 +1,249 @@
+from logging import debug
+from threading import Lock
+
 import numpy as np
-from constants import NORM_SR
-from librosa import load
-from scipy.signal import fftconvolve
+from constants import (
+    NORM_SR,
+    SYNC_CANDIDATE_DISTANCE,
+    SYNC_CANDIDATES,
+    SYNC_ENVELOPE_RATE,
+    SYNC_MEMORY_BYTES,
+    SYNC_MIN_CONFIDENCE,
+    SYNC_REFINE_RATE,
+    SYNC_STREAM_SECONDS,
+)
+from scipy.fft import irfft, next_fast_len, rfft
+from scipy.signal import find_peaks, resample_poly
 
 
 class Synchronizer:
-    def __init__(self, audio_paths):
-        self.audios_to_sync = [self.load_audio(p) for p in audio_paths[:-1]]
-        self.audio_reference = self.load_audio(audio_paths[-1])
-
-    def load_audio(self, audio_path):
-        data, _ = load(audio_path, dtype="float64", sr=int(NORM_SR))
-        return data
-
-    def find_audio_offset(self, reference_audio, target_audio):
-        # Use fftconvolve over inverted reference audio to compute cross correlation efficiently
-        cross_correlation = fftconvolve(target_audio, reference_audio[::-1], mode="full")
-        offset = np.argmax(abs(cross_correlation)) - (len(reference_audio) - 1)
+    def __init__(
+        self,
+        audio_reference,
+        sample_rate=int(NORM_SR),
+        max_target_length=0,
+        memory_bytes=SYNC_MEMORY_BYTES,
+    ):
+        # audios are decoded at NORM_SR, as float32
+        self.audio_reference = audio_reference
+        self.sample_rate = sample_rate
+        self.envelope_factor = max(1, sample_rate // SYNC_ENVELOPE_RATE)
+        self.refine_factor = max(1, sample_rate // SYNC_REFINE_RATE)
+        # the reference envelope, decimated audio and block spectra are computed once for
+        # all targets, the blocks fit targets of max_target_length samples
+        self.max_target_length = max_target_length
+        self.memory_bytes = memory_bytes
+        self.reference_envelope = None
+        self.max_target_envelope_length = 0
+        self.lock = Lock()
+        self.correlation_lock = Lock()
+
+    def _prepare_reference(self, target_envelope_length):
+        with self.lock:
+            if self.reference_envelope is None:
+                self.reference_envelope = self.envelope(self.audio_reference)
+                self.reference_refine = resample_poly(
+                    self.audio_reference, 1, self.refine_factor
+                ).astype(np.float32)
+            target_envelope_length = max(
+                target_envelope_length, self.max_target_length // self.envelope_factor
+            )
+            if target_envelope_length > self.max_target_envelope_length:
+                self._split_reference(target_envelope_length)
+            return self.fft_length, self.block_step, self.reference_spectra
+
+    def _split_reference(self, target_envelope_length):
+        """
+        Split the reversed reference envelope in overlap-save blocks of fft_length samples,
+        the transforms of a block, its spectrum and the product with a target spectrum take
+        about 16 bytes per sample and must fit in memory_bytes.
+        """
+        reference_length = len(self.reference_envelope)
+        correlation_length = reference_length + target_envelope_length - 1
+        fft_length = max(2 * target_envelope_length, self.memory_bytes // 16)
+        # a single block holds the whole correlation after the wrapped around lags
+        single_block_length = correlation_length + target_envelope_length - 1
+        self.fft_length = next_fast_len(min(single_block_length, fft_length), real=True)
+        # every block gives the correlation at block_step lags
+        self.block_step = self.fft_length - target_envelope_length + 1
+        n_blocks = -(-correlation_length // self.block_step)
+        padded = np.zeros((n_blocks - 1) * self.block_step + self.fft_length, np.float32)
+        padded[target_envelope_length - 1 :][:reference_length] = self.reference_envelope[::-1]
+        self.reference_spectra = [
+            rfft(padded[idx * self.block_step :][: self.fft_length]) for idx in range(n_blocks)
+        ]
+        self.max_target_envelope_length = target_envelope_length
+
+    def envelope_correlation(self, target_envelope):
+        """
+        Cross correlation of the target and reference envelopes, block by block
+        """
+        fft_length, block_step, reference_spectra = self._prepare_reference(
+            len(target_envelope)
+        )
+        target_spectrum = rfft(target_envelope, fft_length)
+        correlation = np.empty(len(reference_spectra) * block_step, np.float32)
+        for idx, reference_spectrum in enumerate(reference_spectra):
+            # the first fft_length - block_step lags wrap around
+            block = irfft(reference_spectrum * target_spectrum, fft_length)
+            correlation[idx * block_step :][:block_step] = block[fft_length - block_step :]
+        return correlation[: len(self.reference_envelope) + len(target_envelope) - 1]
+
+    @staticmethod
+    def correlation_at(reference_audio, target_audio, lags):
+        # cross correlation only at the given lags, target[n] is compared with reference[n - lag]
+        correlation = np.zeros(len(lags))
+        for idx, lag in enumerate(lags):
+            start = max(0, lag)
+            end = min(len(target_audio), len(reference_audio) + lag)
+            if end > start:
+                correlation[idx] = np.dot(
+                    target_audio[start:end], reference_audio[start - lag : end - lag]
+                )
+        return correlation
+
+    def envelope(self, audio):
+        # mean absolute amplitude of blocks of envelope_factor samples, without the mean
+        n_blocks = len(audio) // self.envelope_factor
+        envelope = np.empty(n_blocks, np.float32)
+        # a chunk at a time, not to hold the absolute value of the whole audio
+        chunk_blocks = 1 << 16
+        for idx in range(0, n_blocks, chunk_blocks):
+            blocks = audio[idx * self.envelope_factor :][: chunk_blocks * self.envelope_factor]
+            blocks = blocks[: len(blocks) // self.envelope_factor * self.envelope_factor]
+            envelope[idx:][:chunk_blocks] = (
+                np.abs(blocks).reshape(-1, self.envelope_factor).mean(axis=1)
+            )
+        return envelope - envelope.mean()
+
+    def find_audio_offset_exact(self, target_audio):
+        """
+        Offset maximizing the cross correlation of the audios and the ratio between its peak
+        and the highest peak a candidate distance or more away. The correlation is computed
+        for a block of lags and a chunk of the target at a time, with transforms taking about
+        24 bytes per sample of fft_length, fft_length fitting in memory_bytes, and only the
+        peaks of each block are kept. One target is correlated at a time.
+        """
+        reference_length, target_length = len(self.audio_reference), len(target_audio)
+        fft_length = next_fast_len(
+            min(max(self.memory_bytes // 24, 1 << 16), reference_length + 2 * target_length),
+            real=True,
+        )
+        chunk_length = min(target_length, fft_length // 2)
+        # every block gives the correlation at block_step lags
+        block_step = fft_length - chunk_length + 1
+        distance = int(SYNC_CANDIDATE_DISTANCE * self.sample_rate)
+        lags, peaks = [], []
+        with self.correlation_lock:
+            for first_lag in range(-(reference_length - 1), target_length, block_step):
+                correlation = np.zeros(block_step)
+                for chunk_start in range(0, target_length, chunk_length):
+                    # the reference samples compared with the chunk at the lags of the block
+                    start = chunk_start - first_lag - (block_step - 1)
+                    end = min(start + fft_length, reference_length)
+                    if end <= max(0, start):
+                        continue
+                    segment = np.zeros(fft_length, np.float32)
+                    segment[max(0, -start) : end - start] = self.audio_reference[
+                        max(0, start) : end
+                    ]
+                    spectrum = rfft(segment)
+                    spectrum *= np.conj(
+                        rfft(target_audio[chunk_start:][:chunk_length], fft_length)
+                    )
+                    correlation += irfft(spectrum, fft_length)[block_step - 1 :: -1]
+                correlation = np.abs(correlation[: target_length - first_lag])
+                block_peaks, _ = find_peaks(correlation, distance=distance)
+                # a peak at the edge of the block is only found as its maximum
+                block_peaks = np.append(block_peaks, np.argmax(correlation))
+                lags.append(first_lag + block_peaks)
+                peaks.append(correlation[block_peaks])
+        lags, peaks = np.concatenate(lags), np.concatenate(peaks)
+        best = int(np.argmax(peaks))
+        next_peak = peaks[np.abs(lags - lags[best]) > distance].max(initial=0.0)
+        confidence = float(peaks[best] / next_peak) if next_peak > 0 else float("inf")
+        return int(lags[best]), confidence
+
+    def coarse_candidates(self, target_envelope):
+        """
+        Offsets in envelope blocks of the highest envelope correlation peaks
+        """
+        correlation = self.envelope_correlation(target_envelope)
+        distance = max(1, int(SYNC_CANDIDATE_DISTANCE * SYNC_ENVELOPE_RATE))
+        peaks, _ = find_peaks(correlation, distance=distance)
+        if len(peaks) == 0:
+            peaks = np.array([np.argmax(correlation)])
+        peaks = peaks[np.argsort(correlation[peaks])[::-1][:SYNC_CANDIDATES]]
+        return peaks - (len(self.reference_envelope) - 1)
+
+    def refine(self, reference_audio, target_audio, offset, radius):
+        # best offset and its correlation within radius samples of offset
+        lags = np.arange(offset - radius, offset + radius + 1)
+        correlation = np.abs(self.correlation_at(reference_audio, target_audio, lags))
+        best = np.argmax(correlation)
+        return int(lags[best]), correlation[best]
+
+    def refine_offset(self, target_audio, offset, radius):
+        """
+        Best offset within radius samples of offset, searched on the decimated audios and
+        then around the decimated best on the audios
+        """
+        self._prepare_reference(1)
+        target_refine = resample_poly(target_audio, 1, self.refine_factor).astype(np.float32)
+        offset, _ = self.refine(
+            self.reference_refine,
+            target_refine,
+            round(offset / self.refine_factor),
+            radius // self.refine_factor + 2,
+        )
+        offset, _ = self.refine(
+            self.audio_reference,
+            target_audio,
+            offset * self.refine_factor,
+            2 * self.refine_factor,
+        )
         return offset
 
-    def run(self) -> list[tuple[float, float]]:
+    def find_audio_offset(self, target_audio):
+        """
+        Return the offset maximizing the cross correlation with the reference and the ratio
+        between its peak and the peak of the next best candidate. Candidates are found on the
+        envelopes, refined on the audios decimated to SYNC_REFINE_RATE and the best one on the
+        audios. When no candidate stands out, the full correlation of the audios is searched.
+        """
+        target_envelope = self.envelope(target_audio)
+        if min(len(self.audio_reference), len(target_audio)) < self.sample_rate:
+            # less than a second, too short for the envelopes
+            return self.find_audio_offset_exact(target_audio)
+        candidates = self.coarse_candidates(target_envelope)
+        target_refine = resample_poly(target_audio, 1, self.refine_factor).astype(np.float32)
+        refine_per_block = self.envelope_factor // self.refine_factor
+        refined = [
+            self.refine(
+                self.reference_refine,
+                target_refine,
+                candidate * refine_per_block,
+                2 * refine_per_block,
+            )
+            for candidate in candidates
+        ]
+        refined.sort(key=lambda candidate: candidate[1], reverse=True)
+        offset, peak = refined[0]
+        next_peak = refined[1][1] if len(refined) > 1 else 0.0
+        confidence = peak / next_peak if next_peak > 0 else float("inf")
+        if confidence < SYNC_MIN_CONFIDENCE:
+            # the true offset may not be among the envelope candidates of a noisy target
+            debug(f"Envelope candidates ambiguous ({confidence:.2f}), correlating the audios")
+            return self.find_audio_offset_exact(target_audio)
+        offset, _ = self.refine(
+            self.audio_reference,
+            target_audio,
+            offset * self.refine_factor,
+            2 * self.refine_factor,
+        )
+        return offset, confidence
+
+    def offsets(self, audio) -> tuple[int, int, float]:
         """
         return start and end offsets, both computed having as zero the start and end second of the audio reference.
         if both offset positive, audio starts and ends before reference
@@ -34,13 +258,38 @@ class Synchronizer:
         start positive end negative
         reference     |-----------|
         audio      |-------------------|
+        and the confidence of the match, see find_audio_offset
+        """
+        start_offset, confidence = self.find_audio_offset(audio)
+        end_offset = self.audio_reference.size - (audio.size + start_offset)
+        return start_offset, end_offset, confidence
+
+    def offsets_stream(self, chunks, n_samples) -> tuple[int, int, float]:
+        """
+        Synchronize an audio while it is decoded. The offset is searched on the audio decoded
+        so far every time it doubles from SYNC_STREAM_SECONDS, and reading chunks stops when
+        two searches in a row find the same offset with a confident peak. n_samples, the
+        expected length of the whole audio, gives the end offset when it stops early.
         """
-        audio_offsets = []
-        for audio in self.audios_to_sync:
-            start_offset = self.find_audio_offset(self.audio_reference, audio)
-            end_offset = self.audio_reference.size - (audio.size + start_offset)
-            audio_offsets.append((start_offset, end_offset))
-        return audio_offsets
+        decoded = []
+        n_decoded = 0
+        next_search = SYNC_STREAM_SECONDS * self.sample_rate
+        previous_offset = None
+        for chunk in chunks:
+            decoded.append(chunk)
+            n_decoded += len(chunk)
+            if n_decoded < next_search:
+                continue
+            audio = np.concatenate(decoded)
+            decoded = [audio]
+            offset, confidence = self.find_audio_offset(audio)
+            if offset == previous_offset and confidence >= SYNC_MIN_CONFIDENCE:
+                debug(f"Offset {offset} locked after {n_decoded} samples")
+                end_offset = self.audio_reference.size - (n_samples + offset)
+                return offset, end_offset, confidence
+            previous_offset = offset
+            next_search *= 2
+        return self.offsets(np.concatenate(decoded))
 
 
 if __name__ == "__main__":
@@ -1,19 +1,42 @@
 from argparse import ArgumentParser, ArgumentTypeError
-from logging import DEBUG, INFO, basicConfig, error, info
-from os.path import join, exists
+from concurrent.futures import ProcessPoolExecutor
+from logging import DEBUG, INFO, basicConfig, error, getLogger, info
+from multiprocessing import get_context
 from os import mkdir
-from random import choice
-
-from constants import NORM_FPS, OUT_FOLDER, OUT_HEIGHT, OUT_WIDTH
-from cv2 import (
-    CAP_PROP_POS_FRAMES,
-    VideoWriter,
-    VideoWriter_fourcc,
-    destroyAllWindows,
-    resize,
+from os.path import basename, exists, join
+from random import randrange
+from subprocess import CalledProcessError
+from sys import exit
+
+import numpy as np
+from BatchRunner import BatchRunner, init_worker
+from constants import (
+    CACHE_FOLDER,
+    CACHE_MAX_BYTES,
+    CPU_BUDGET,
+    DEFAULT_ENCODE_PROFILE,
+    ENCODE_PROFILES,
+    LOGGING_FORMAT,
+    NORM_FPS,
+    OUT_FOLDER,
+    OUT_HEIGHT,
+    OUT_WIDTH,
+    PLAN_EXTENSION,
+    PREVIEW_ENCODE_PROFILE,
+    PREVIEW_HEIGHT,
+    PREVIEW_WIDTH,
+    RENDER_CHUNK_FOLDER,
+    SCRATCH_TIERS,
+    SYNC_ENGINES,
+    SYNC_MEMORY_BYTES,
 )
+from EditDecisionList import EditDecisionList
 from FileManager import FileManager
+from FilterGraphRenderer import FilterGraphRenderer
+from FramePrefetcher import FramePrefetcher
+from IntermediateCache import IntermediateCache
 from MultiTake import MultiTake
+from RenderSink import RenderSink
 
 
 class VideoEditor:
@@ -22,24 +45,85 @@ class VideoEditor:
         base_folder: str,
         start: int = 30,
         video_duration: int = 30,
+        encode_profile: str = DEFAULT_ENCODE_PROFILE,
+        time_budget: float = None,
+        cache: IntermediateCache = None,
+        normalize: bool = False,
+        scratch_tiers: dict = SCRATCH_TIERS,
+        sync_memory_bytes: int = SYNC_MEMORY_BYTES,
+        sync_engine: str = "waveform",
+        sync_refine: bool = False,
+        sync_stream: bool = False,
+        preview: bool = False,
     ) -> None:
         self.video_out_fps = int(NORM_FPS)
         self.video_out_width = OUT_WIDTH
         self.video_out_heigth = OUT_HEIGHT
         self.video_out_aspect_ratio = self.video_out_width / self.video_out_heigth
+        # previews are rendered fast from small proxies of the original videos, with the
+        # same plans as the full size renders
+        self.preview = preview
+        if preview:
+            encode_profile = PREVIEW_ENCODE_PROFILE
+            time_budget = None
+            normalize = False
 
         self.start = start
         self.base_folder = base_folder
         self.video_duration = video_duration
-        self.file_manager = FileManager(self.base_folder)
-        self.file_manager.create_normalized_audiofiles()
-        (
-            self.start_offsets,
-            self.finish_offsets,
-        ) = self.file_manager.cut_videos_based_on_offsets(start=start, duration=video_duration)
-        self.file_manager.normalize_sync_videofiles()
+        self.file_manager = FileManager(
+            self.base_folder,
+            encode_profile,
+            cache,
+            scratch_tiers,
+            sync_memory_bytes,
+            sync_engine,
+            sync_refine,
+            sync_stream,
+        )
+        try:
+            if time_budget:
+                self.file_manager.calibrate_encoder(video_duration, time_budget, normalize)
+            (
+                self.start_offsets,
+                self.finish_offsets,
+            ) = self.file_manager.process_videos(
+                start=start, duration=video_duration, normalize=normalize
+            )
+            if preview:
+                self.use_proxies()
+            else:
+                self.multitake = MultiTake(
+                    self.file_manager.sync_audiopath,
+                    self.file_manager.render_videopaths,
+                    self.file_manager.render_videos_metadata,
+                    self.file_manager.render_frame_times,
+                    self.file_manager.render_time_offsets,
+                    self.file_manager.render_beat_times,
+                )
+        except BaseException:
+            # scratch folders may be in memory, don't leave them behind
+            self.file_manager.remove_tmp_folder_and_contents()
+            raise
+
+    def use_proxies(self):
+        """
+        Render at the preview size from proxies of the videos, cropped like the videos are
+        """
+        videos_info = self.file_manager.videos_info
+        crop_rects = [self.calculate_largest_rect(i.width, i.height) for i in videos_info]
+        self.video_out_width = PREVIEW_WIDTH
+        self.video_out_heigth = PREVIEW_HEIGHT
+        proxy_paths, proxy_frame_times = self.file_manager.create_proxies(
+            crop_rects, PREVIEW_WIDTH, PREVIEW_HEIGHT
+        )
         self.multitake = MultiTake(
-            self.file_manager.sync_audiopath, self.file_manager.normalized_videopaths
+            self.file_manager.sync_audiopath,
+            proxy_paths,
+            [(PREVIEW_WIDTH, PREVIEW_HEIGHT, i.frame_rate) for i in videos_info],
+            proxy_frame_times,
+            self.file_manager.start_offsets,
+            self.file_manager.render_beat_times,
         )
 
     def __enter__(self):
@@ -60,80 +144,258 @@ class VideoEditor:
             height_with_aspect_ratio = int(max_width / self.video_out_aspect_ratio)
             return max_width, height_with_aspect_ratio
 
-    def get_candidate_video_idxs(self, curr_frame, finish_frame):
-        idxs = []
-        curr_time = curr_frame / self.video_out_fps
-        curr_time += self.start
+    def get_candidate_videos(self, curr_frames, finish_frames):
+        """
+        Whether each video covers each output frame, as an array of (frames, videos)
+        """
+        curr_times = np.asarray(curr_frames)[:, None] / self.video_out_fps + self.start
+        finish_frames = np.asarray(finish_frames)[:, None]
         audio_total_duration = self.file_manager.audio_duration
-        for idx, (start_offset, finish_offset) in enumerate(
-            zip(self.start_offsets, self.finish_offsets)
-        ):
-            if (
-                curr_time + start_offset >= 0.0
-                and audio_total_duration - finish_offset - curr_time + finish_frame >= 0.0
-            ):
-                idxs.append(idx)
-        return idxs
+        start_offsets = np.asarray(self.start_offsets)
+        finish_offsets = np.asarray(self.finish_offsets)
+        return (curr_times + start_offsets >= 0.0) & (
+            audio_total_duration - finish_offsets - curr_times + finish_frames >= 0.0
+        )
 
     def get_candidate_change_frames(self):
         return self.multitake.audio_beats
 
-    def create_video(self):
-        out_folder = join(self.file_manager.base_folder, OUT_FOLDER)
-        if not exists(out_folder):
-            mkdir(out_folder)
-        video_tmp_path = join(self.file_manager.temp_folder, "tmp.mp4")
-        # Create an output video writer
-        out = VideoWriter(
-            video_tmp_path,
-            VideoWriter_fourcc(*"mp4v"),
-            30,
-            (self.video_out_width, self.video_out_heigth),
+    def get_reference_times(self, out_frame, n_frames):
+        # second of the reference audio shown at each output frame
+        return self.start + (out_frame + np.arange(n_frames)) / self.video_out_fps
+
+    def get_start_frames(self, video_idxs, out_frames):
+        # first frame of each video shown at each output frame
+        reference_times = self.get_reference_times(np.asarray(out_frames), 1)
+        start_frames = np.zeros(len(video_idxs), np.int64)
+        for video_idx in np.unique(video_idxs):
+            shown = video_idxs == video_idx
+            start_frames[shown] = self.multitake.get_source_frames(
+                int(video_idx), reference_times[shown]
+            )
+        return start_frames
+
+    def get_video_names(self):
+        return [basename(path) for path in self.file_manager.video_filepaths]
+
+    def plan_segments(self, seed=None):
+        """
+        Choose the video shown between every pair of change frames, at random among the
+        videos covering its first frames. The same seed gives the same plan.
+        """
+        if seed is None:
+            seed = randrange(2**32)
+        rng = np.random.default_rng(seed)
+        n_frames = int(self.video_out_fps * self.video_duration)
+        change_frames = np.unique(np.asarray(self.get_candidate_change_frames(), np.int64))
+        change_frames = change_frames[(change_frames > 0) & (change_frames < n_frames)]
+        segment_bounds = np.concatenate([[0], change_frames, [n_frames]])
+        out_frames = segment_bounds[:-1]
+        candidates = self.get_candidate_videos(out_frames, out_frames + 10)
+        n_candidates = candidates.sum(axis=1)
+        if not n_candidates.all():
+            uncovered = out_frames[np.argmin(n_candidates)]
+            raise ValueError(f"No video covers output frame {uncovered}")
+        # the video of each segment is its n-th candidate, for a random n
+        picks = (rng.random(len(out_frames)) * n_candidates).astype(np.int64)
+        video_idxs = np.argmax(np.cumsum(candidates, axis=1) > picks[:, None], axis=1)
+        segments = np.column_stack(
+            [
+                video_idxs,
+                self.get_start_frames(video_idxs, out_frames),
+                out_frames,
+                np.diff(segment_bounds),
+            ]
         )
-        change_frames = self.get_candidate_change_frames()
-        cap = None
-        for frame_idx in range(int(self.video_out_fps * self.video_duration)):
-            if not cap or frame_idx in change_frames:
-                if cap:
-                    cap.release()
-                info(f"Processing segment {frame_idx}")
-                candidate_idxs = self.get_candidate_video_idxs(frame_idx, frame_idx + 10)
-                info(candidate_idxs)
-                video_idx = choice(candidate_idxs)
-                cap = self.multitake.get_video_clip(video_idx)
-                (
-                    frame_width,
-                    frame_height,
-                    frame_rate,
-                ) = self.multitake.get_video_metadata(video_idx)
-                start_offset = self.start_offsets[video_idx]
-                start_offset_corrected = (
-                    start_offset
-                    if (start_offset < 0.0 and -start_offset > self.start)
-                    else 0.0
+        info(f"Planned {len(segments)} segments with seed {seed}")
+        return EditDecisionList(
+            segments, self.start, self.video_duration, self.get_video_names(), seed
+        )
+
+    def load_plan(self, plan_path):
+        """
+        Plan saved by a previous run with the same videos and cut. Its start frames are
+        found again, they differ between normalized and original videos.
+        """
+        plan = EditDecisionList.load(plan_path)
+        if (plan.video_names, plan.start, plan.duration) != (
+            self.get_video_names(),
+            self.start,
+            self.video_duration,
+        ):
+            raise ValueError(f"{plan_path} was planned for other videos, start or duration")
+        plan.segments[:, 1] = self.get_start_frames(plan.video_idxs, plan.out_frames)
+        info(f"Loaded {len(plan)} segments planned with seed {plan.seed}")
+        return plan
+
+    def __getstate__(self):
+        # chunks are rendered in other processes from the plan, without the file manager
+        state = dict(self.__dict__)
+        del state["file_manager"]
+        return state
+
+    def create_video(
+        self, backend="opencv", out_path=None, render_workers=1, plan=None, dry_run=False
+    ):
+        """
+        Render the plan, or a new one, and save the plan next to the output so it can be
+        rendered again. With dry_run only the plan is saved.
+        """
+        if out_path is None:
+            out_folder = join(self.file_manager.base_folder, OUT_FOLDER)
+            if not exists(out_folder):
+                mkdir(out_folder)
+            out_path = join(out_folder, "preview.mp4" if self.preview else "out.mp4")
+        if plan is None:
+            plan = self.plan_segments()
+        plan_path = out_path.rsplit(".", 1)[0] + PLAN_EXTENSION
+        plan.save(plan_path)
+        info(f"Plan saved to {plan_path}")
+        if dry_run:
+            return
+        segments = list(plan)
+        # the seconds of every video its segments read, from about their start frames
+        video_seconds = {}
+        for video_idx, _, _, n_frames in segments:
+            video_seconds[video_idx] = (
+                video_seconds.get(video_idx, 0.0) + n_frames / self.video_out_fps
+            )
+        read_paths = [self.multitake.audio_path] + [
+            (
+                self.multitake.video_paths[video_idx],
+                seconds / max(self.multitake.frame_pts[video_idx][-1], 1 / self.video_out_fps),
+            )
+            for video_idx, seconds in sorted(video_seconds.items())
+        ]
+        with self.file_manager.io_stats.measure("render", read_paths, [out_path]):
+            self.render(backend, segments, out_path, render_workers)
+        info(self.file_manager.io_stats.report())
+
+    def render(self, backend, segments, out_path, render_workers=1):
+        encode_parameters = self.file_manager.ffmpeg_commands.encode_parameters()
+        threads = self.file_manager.ffmpeg_commands.threads
+        if backend == "filtergraph":
+            renderer = FilterGraphRenderer(
+                self.multitake.video_paths,
+                self.multitake.frame_pts,
+                self.get_crop_rects(),
+                self.video_out_width,
+                self.video_out_heigth,
+                self.video_out_fps,
+                encode_parameters,
+                threads,
+            )
+            renderer.render(segments, self.multitake.audio_path, out_path)
+            return
+        if render_workers > 1:
+            self.render_chunks(segments, out_path, render_workers, encode_parameters)
+            return
+        # Frames are encoded and muxed with the sync audio as they are produced
+        sink = RenderSink(
+            out_path,
+            self.video_out_width,
+            self.video_out_heigth,
+            self.video_out_fps,
+            self.multitake.audio_path,
+            encode_parameters,
+            threads,
+        )
+        with sink:
+            self.write_frames(segments, sink)
+
+    @staticmethod
+    def split_segments(segments, n_chunks):
+        """
+        Split the segments in up to n_chunks runs of consecutive segments with about the same
+        number of frames
+        """
+        n_frames = sum(segment[3] for segment in segments)
+        chunks = [[]]
+        chunk_frames = 0
+        for segment in segments:
+            if chunks[-1] and chunk_frames >= len(chunks) * n_frames / n_chunks:
+                chunks.append([])
+            chunks[-1].append(segment)
+            chunk_frames += segment[3]
+        return chunks
+
+    def render_chunks(self, segments, out_path, render_workers, encode_parameters):
+        """
+        Render runs of segments in parallel processes, each into a video starting with a
+        keyframe, and join them without re-encoding while muxing the sync audio
+        """
+        chunks = self.split_segments(segments, render_workers)
+        # 1 MB per second of video is plenty at the output size
+        chunk_folder = self.file_manager.scratch.folder(
+            "video", RENDER_CHUNK_FOLDER, int(self.video_duration * 1024**2)
+        )
+        chunk_paths = [join(chunk_folder, f"chunk{i}.mp4") for i in range(len(chunks))]
+        threads = max(1, CPU_BUDGET // len(chunks))
+        info(f"Rendering {len(chunks)} chunks in parallel...")
+        with ProcessPoolExecutor(
+            max_workers=len(chunks),
+            mp_context=get_context("spawn"),
+            initializer=init_worker,
+            initargs=(getLogger().level == DEBUG,),
+        ) as executor:
+            futures = [
+                executor.submit(
+                    render_chunk, self, chunk, chunk_path, encode_parameters, threads
                 )
-                # compute starting frame index for the current segment based on start_offset
-                start_frame = int(frame_rate * start_offset_corrected + frame_idx)
-                # Set the starting frame
-                info(f"start frame {start_frame}")
-                cap.set(CAP_PROP_POS_FRAMES, start_frame)
-
-            # Extract and write frames for the segment
-            ret, frame = cap.read()
-            if not ret:
-                error(f"Frame idx {frame_idx} not read for video {video_idx}")
-                continue
-            max_width, max_height = self.calculate_largest_rect(frame_width, frame_height)
-            crop_frame = frame[0:max_height, 0:max_width]
-            resized_frame = resize(crop_frame, (self.video_out_width, self.video_out_heigth))
-            out.write(resized_frame)
-        # Release output video writer
-        out.release()
-        destroyAllWindows()
-        final_video_out_path = join(out_folder, "out.mp4")
-        self.file_manager.video_audio_to_instavideo(
-            self.multitake.audio_path, video_tmp_path, final_video_out_path
+                for chunk, chunk_path in zip(chunks, chunk_paths)
+            ]
+            for future in futures:
+                future.result()
+        ffmpeg_commands = self.file_manager.ffmpeg_commands
+        results = ffmpeg_commands.run_command(
+            ffmpeg_commands.concat_video_and_audio,
+            chunk_paths,
+            self.multitake.audio_path,
+            out_path,
         )
+        for result in results:
+            if result.return_code != 0:
+                raise CalledProcessError(result.return_code, result.argv, stderr=result.stderr)
+
+    def get_crop_rects(self):
+        return [self.calculate_largest_rect(w, h) for w, h, _ in self.multitake.video_metadata]
+
+    def produce_frames(self, segments):
+        # output frames in order, cropped and scaled by the decoders
+        out_size = (self.video_out_width, self.video_out_heigth)
+        with self.multitake.get_decoder_pool(self.get_crop_rects(), out_size) as decoders:
+            for video_idx, start_frame, out_frame, n_frames in segments:
+                info(f"Processing segment of video {video_idx} from frame {start_frame}")
+                source_frames = self.multitake.get_source_frames(
+                    video_idx, self.get_reference_times(out_frame, n_frames)
+                )
+                for frame_idx in source_frames:
+                    frame = decoders.read(video_idx, int(frame_idx))
+                    if frame is None:
+                        error(f"Frame idx {frame_idx} not read for video {video_idx}")
+                        continue
+                    yield frame
+
+    def write_frames(self, segments, sink):
+        # frames are decoded in a background thread while the previous ones are encoded
+        with FramePrefetcher(self.produce_frames(segments)) as frames:
+            for frame in frames:
+                sink.write(frame)
+
+
+def render_chunk(video_editor, segments, out_path, encode_parameters, threads):
+    # video only, the audio is muxed once the chunks are joined
+    sink = RenderSink(
+        out_path,
+        video_editor.video_out_width,
+        video_editor.video_out_heigth,
+        video_editor.video_out_fps,
+        None,
+        encode_parameters,
+        threads,
+    )
+    with sink:
+        video_editor.write_frames(segments, sink)
 
 
 def check_positive(value):
@@ -149,10 +411,37 @@ if __name__ == "__main__":
         "--folder",
         action="store",
         type=str,
-        required=True,
+        required=False,
         dest="folder",
         help="Folder containing 'Audio' folder with 1 audio file and 'Videos' folder with N videos",
     )
+    parser.add_argument(
+        "--manifest",
+        action="store",
+        type=str,
+        required=False,
+        dest="manifest",
+        help="Json list of jobs with 'folder', 'start', 'duration' and 'output' to render "
+        "in batch, finished jobs are skipped when the batch is run again",
+    )
+    parser.add_argument(
+        "--workers",
+        action="store",
+        type=int,
+        required=False,
+        default=2,
+        dest="workers",
+        help="Jobs rendered at the same time in batch mode, sharing the cpu budget",
+    )
+    parser.add_argument(
+        "--cpu-budget",
+        action="store",
+        type=int,
+        required=False,
+        default=CPU_BUDGET,
+        dest="cpu_budget",
+        help="Cores used by all the jobs of a batch together",
+    )
     parser.add_argument(
         "--start",
         action="store",
@@ -171,6 +460,164 @@ if __name__ == "__main__":
         dest="duration",
         help="Duration of the resulting video in seconds",
     )
+    parser.add_argument(
+        "--profile",
+        action="store",
+        type=str,
+        required=False,
+        default=DEFAULT_ENCODE_PROFILE,
+        choices=ENCODE_PROFILES.keys(),
+        dest="profile",
+        help="Encode profile used for every encoded video",
+    )
+    parser.add_argument(
+        "--time-budget",
+        action="store",
+        type=check_positive,
+        required=False,
+        default=None,
+        dest="time_budget",
+        help="Calibrate the encoder preset to encode all videos within this many seconds",
+    )
+    parser.add_argument(
+        "--backend",
+        action="store",
+        type=str,
+        required=False,
+        default="opencv",
+        choices=["opencv", "filtergraph"],
+        dest="backend",
+        help="Render frames in python with opencv or in a single ffmpeg filtergraph",
+    )
+    parser.add_argument(
+        "--seed",
+        action="store",
+        type=int,
+        required=False,
+        default=None,
+        dest="seed",
+        help="Seed of the random choice of videos, the same seed gives the same edit",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store",
+        type=str,
+        required=False,
+        default=None,
+        dest="plan",
+        help="Render the edit planned by a previous run, saved next to its output as "
+        f"*{PLAN_EXTENSION}",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        required=False,
+        dest="dry_run",
+        help="Synchronize and save the plan of the edit without rendering it",
+    )
+    parser.add_argument(
+        "--preview",
+        action="store_true",
+        required=False,
+        dest="preview",
+        help=f"Render a {PREVIEW_WIDTH}x{PREVIEW_HEIGHT} preview from proxies of the videos, "
+        "created once, into Out/preview.mp4. Its plan renders the full size video with --plan",
+    )
+    parser.add_argument(
+        "--render-workers",
+        action="store",
+        type=int,
+        required=False,
+        default=1,
+        dest="render_workers",
+        help="Render the opencv backend in this many chunks in parallel, joined without "
+        "re-encoding",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        action="store",
+        type=str,
+        required=False,
+        default=CACHE_FOLDER,
+        dest="cache_dir",
+        help="Folder where intermediate files are cached across runs",
+    )
+    parser.add_argument(
+        "--cache-size",
+        action="store",
+        type=check_positive,
+        required=False,
+        default=CACHE_MAX_BYTES / 1024**3,
+        dest="cache_size",
+        help="Disk budget of the cache in GB, least recently used entries are evicted",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="no_cache",
+        action="store_true",
+        help="Don't read or write cached intermediate files",
+    )
+    parser.add_argument(
+        "--normalize",
+        dest="normalize",
+        action="store_true",
+        help="Cut and re-encode videos to a constant frame rate before rendering, "
+        "for files that can't be seeked accurately",
+    )
+    parser.add_argument(
+        "--scratch-audio",
+        action="store",
+        type=str,
+        nargs="+",
+        required=False,
+        default=SCRATCH_TIERS["audio"],
+        dest="scratch_audio",
+        help="Folders tried in order for intermediate audio files, before the project folder",
+    )
+    parser.add_argument(
+        "--scratch-video",
+        action="store",
+        type=str,
+        nargs="+",
+        required=False,
+        default=SCRATCH_TIERS["video"],
+        dest="scratch_video",
+        help="Folders tried in order for intermediate video files, before the project folder",
+    )
+    parser.add_argument(
+        "--sync-memory",
+        action="store",
+        type=check_positive,
+        required=False,
+        default=SYNC_MEMORY_BYTES / 1024**3,
+        dest="sync_memory",
+        help="Memory in GB for the audios being synchronized, videos are synchronized one "
+        "at a time when they don't fit",
+    )
+    parser.add_argument(
+        "--sync-engine",
+        action="store",
+        type=str,
+        required=False,
+        default="waveform",
+        choices=SYNC_ENGINES,
+        dest="sync_engine",
+        help="Synchronize the audio waveforms or their onset strength fingerprints, "
+        "fingerprints cope better with noisy camera microphones",
+    )
+    parser.add_argument(
+        "--sync-refine",
+        dest="sync_refine",
+        action="store_true",
+        help="Refine fingerprint offsets on the audio waveforms",
+    )
+    parser.add_argument(
+        "--sync-stream",
+        dest="sync_stream",
+        action="store_true",
+        help="Synchronize waveforms while the video audio is decoded, and stop decoding "
+        "once the offset is found",
+    )
     parser.add_argument(
         "--test",
         "-t",
@@ -186,20 +633,99 @@ if __name__ == "__main__":
         help="Show debug messages and ffmpeg commands",
     )
     args = parser.parse_args()
-    logging_format = "[%(asctime)s] %(filename)s:%(lineno)d\t%(levelname)s - %(message)s"
+    if (args.folder is None) == (args.manifest is None):
+        parser.error("one of --folder or --manifest is required")
     if args.debug:
         basicConfig(
             level=DEBUG,
-            format=logging_format,
+            format=LOGGING_FORMAT,
         )
     else:
         basicConfig(
             level=INFO,
-            format=logging_format,
+            format=LOGGING_FORMAT,
+        )
+    cache = (
+        None
+        if args.no_cache
+        else IntermediateCache(args.cache_dir, int(args.cache_size * 1024**3))
+    )
+    scratch_tiers = {"audio": args.scratch_audio, "video": args.scratch_video}
+    if args.manifest:
+        batch_runner = BatchRunner(
+            args.manifest,
+            workers=args.workers,
+            cpu_budget=args.cpu_budget,
+            options=dict(
+                start=args.start,
+                duration=args.duration,
+                encode_profile=args.profile,
+                time_budget=args.time_budget,
+                backend=args.backend,
+                render_workers=args.render_workers,
+                seed=args.seed,
+                dry_run=args.dry_run,
+                preview=args.preview,
+                cache_dir=None if args.no_cache else args.cache_dir,
+                cache_size=int(args.cache_size * 1024**3),
+                normalize=args.normalize,
+                scratch_tiers=scratch_tiers,
+                sync_memory_bytes=int(args.sync_memory * 1024**3),
+                sync_engine=args.sync_engine,
+                sync_refine=args.sync_refine,
+                sync_stream=args.sync_stream,
+                debug=args.debug,
+            ),
         )
+        exit(0 if batch_runner.run() else 1)
     if args.test:
-        video_editor = VideoEditor(args.folder, args.start, args.duration)
-        video_editor.create_video()
+        video_editor = VideoEditor(
+            args.folder,
+            args.start,
+            args.duration,
+            args.profile,
+            None if args.dry_run else args.time_budget,
+            cache,
+            args.normalize,
+            scratch_tiers,
+            int(args.sync_memory * 1024**3),
+            args.sync_engine,
+            args.sync_refine,
+            args.sync_stream,
+            args.preview,
+        )
+        plan = (
+            video_editor.load_plan(args.plan)
+            if args.plan
+            else video_editor.plan_segments(args.seed)
+        )
+        video_editor.create_video(
+            args.backend, render_workers=args.render_workers, plan=plan, dry_run=args.dry_run
+        )
     else:
-        with VideoEditor(args.folder, args.start, args.duration) as video_editor:
-            video_editor.create_video()
+        with VideoEditor(
+            args.folder,
+            args.start,
+            args.duration,
+            args.profile,
+            None if args.dry_run else args.time_budget,
+            cache,
+            args.normalize,
+            scratch_tiers,
+            int(args.sync_memory * 1024**3),
+            args.sync_engine,
+            args.sync_refine,
+            args.sync_stream,
+            args.preview,
+        ) as video_editor:
+            plan = (
+                video_editor.load_plan(args.plan)
+                if args.plan
+                else video_editor.plan_segments(args.seed)
+            )
+            video_editor.create_video(
+                args.backend,
+                render_workers=args.render_workers,
+                plan=plan,
+                dry_run=args.dry_run,
+            )
@@ -1,20 +1,112 @@
+from os import cpu_count, environ
+from os.path import expanduser, join
+from tempfile import gettempdir
+
 # media parameters
 NORM_SR = "8000"
 NORM_AUDIO_CODEC = "pcm_s16le"
 NORM_FPS = "30"
 OUT_WIDTH = 1080
 OUT_HEIGHT = 1920
+# previews are rendered from proxies of the videos at this size
+PREVIEW_WIDTH = 270
+PREVIEW_HEIGHT = 480
+PREVIEW_ENCODE_PROFILE = "preview"
 NORM_VIDEO_CODEC = "libx264"
+OUT_AUDIO_PARAMETERS = [
+    "-c:a",
+    "aac",  # Audio codec (AAC)
+    "-b:a",
+    "128k",  # Audio bitrate
+    "-ar",
+    "44100",  # Sample rate
+    "-ac",
+    "2",  # Stereo
+]
+
+# videos kept open while rendering, and frames decoded ahead before seeking instead
+DECODER_POOL_SIZE = 4
+DECODER_MAX_GRAB = 120
+# output frames decoded ahead of the encoder, about 6 MB each
+RENDER_QUEUE_FRAMES = 16
+
+LOGGING_FORMAT = "[%(asctime)s] %(filename)s:%(lineno)d\t%(levelname)s - %(message)s"
+
+# job scheduling
+# batch workers get their share of the cores through CPU_BUDGET_ENV
+CPU_BUDGET_ENV = "VIDEOEDITOR_CPU_BUDGET"
+CPU_BUDGET = int(environ.get(CPU_BUDGET_ENV, 0)) or cpu_count() or 1
+FFMPEG_THREADS = 2
+
+# encode profiles, presets go from fastest to slowest
+X264_PRESETS = [
+    "ultrafast",
+    "superfast",
+    "veryfast",
+    "faster",
+    "fast",
+    "medium",
+    "slow",
+    "slower",
+    "veryslow",
+]
+ENCODE_PROFILES = {
+    "draft": {"preset": "veryfast", "crf": "28", "tune": "fastdecode", "threads": 1},
+    "social": {"preset": "slow", "crf": "23", "tune": None, "threads": FFMPEG_THREADS},
+    "archive": {"preset": "veryslow", "crf": "18", "tune": "film", "threads": 4},
+    "preview": {"preset": "ultrafast", "crf": "30", "tune": "fastdecode", "threads": 1},
+}
+DEFAULT_ENCODE_PROFILE = "social"
+CALIBRATION_FRAMES = 300
+
+# audio synchronization, candidates found on an envelope are refined at each rate
+SYNC_ENVELOPE_RATE = 100
+SYNC_REFINE_RATE = 1000
+SYNC_CANDIDATES = 5
+# seconds between two candidate offsets
+SYNC_CANDIDATE_DISTANCE = 1.0
+# matches whose peak is less than this times the next candidate peak are ambiguous
+SYNC_MIN_CONFIDENCE = 1.5
+# frames per second of the onset strength fingerprints and samples per analysis window
+SYNC_FINGERPRINT_RATE = 100
+SYNC_FINGERPRINT_WINDOW = 512
+# fingerprint matches whose peak is less than this many standard deviations above the
+# median onsets correlation are ambiguous, the best of unrelated audios scores 4 to 5
+SYNC_FINGERPRINT_MIN_CONFIDENCE = 6.0
+SYNC_ENGINES = ["waveform", "fingerprint"]
+# seconds of audio decoded before the first streaming sync search, doubled for every search
+SYNC_STREAM_SECONDS = 10
+# memory for the audios being synchronized and the correlation transforms
+SYNC_MEMORY_BYTES = 1024**3
+# beats and onsets of the reference audio are tracked on its sync audio, at NORM_SR
+BEAT_HOP_LENGTH = 128
+
+# intermediate cache
+CACHE_FOLDER = join(expanduser("~"), ".cache", "videoeditor")
+CACHE_MAX_BYTES = 20 * 1024**3
+
+# scratch storage for intermediate files, tiers of each kind are tried in order and the
+# project folder is the last resort
+SCRATCH_TIERS = {
+    "audio": ["/dev/shm", gettempdir()],
+    "video": [gettempdir()],
+}
+SCRATCH_RESERVE_BYTES = 512 * 1024**2
 
 # filenames
 TMP_BLACK_VIDEO = "black.mp4"
-CMD_LIST = ".cmd.lst"
+PROBE_CACHE = ".probe_cache.json"
+SYNC_INDEX = ".sync_index.json"
+CONTENT_HASHES = ".content_hashes.json"
+PLAN_EXTENSION = ".plan.json"
 
 # folder names
 AUDIO_FOLDER = "Audio"
 VIDEO_FOLDER = "Videos"
-NORM_AUDIO_FOLDER = "NormAudio"
 NORM_VIDEO_FOLDER = "NormVideo"
 VIDEO_SYNC_FOLDER = "VideoSync"
+RENDER_CHUNK_FOLDER = "RenderChunks"
 BLACK_PNG_FOLDER = "BlackPNG"
 OUT_FOLDER = "Out"
+FRAME_INDEX_FOLDER = ".frame_index"
+PROXY_FOLDER = ".proxies"